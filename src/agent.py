@@ -1,15 +1,65 @@
+import json
 import logging
 import os
+import threading
 from hashlib import sha256
 from pathlib import Path
 from tempfile import TemporaryDirectory
+from typing import Optional
 
-import boto3
+from boto3.s3.transfer import TransferConfig
 from jsonschema import validate
 
-from .utils import clone_repos, flatten, get_watcloud_uris
+from .clients import DEFAULT_MAX_POOL_CONNECTIONS, Bucket, ClientPool
+from .inventory import Inventory
+from .plan import MOVES, Checkpoint, checkpoint_path, read_plan, write_plan
+from .reconcile import DigestSet, reconcile
+from .resolver_service import DigestIndex
+from .retry import AdaptiveLimiter, Retrier, RetryBudget
+from .spool import SpoolManager
+from .transfer import (
+    MAX_COPY_OBJECT_SIZE,
+    DeleteBatcher,
+    HashPipeline,
+    StageStats,
+    TransferExecutor,
+    copy_object,
+    get_native_sha256,
+    stream_object,
+    upload_stream,
+)
+from .utils import clone_repos, get_watcloud_uris
 
 WORKSPACE_DIR = Path(os.getenv("WORKSPACE_DIR", "/tmp/workspace"))
+TRANSFER_CONCURRENCY = int(os.getenv("TRANSFER_CONCURRENCY", "8"))
+# Number of objects transferred in parts at the same time, each in parallel parts
+LARGE_TRANSFER_CONCURRENCY = int(os.getenv("LARGE_TRANSFER_CONCURRENCY", "2"))
+# Attempts per S3 request before it is reported as failed. Retries also draw from a budget shared by all requests.
+TRANSFER_MAX_ATTEMPTS = int(os.getenv("TRANSFER_MAX_ATTEMPTS", "5"))
+# Number of objects hashed at the same time during verification, each on its own core
+HASH_CONCURRENCY = int(os.getenv("HASH_CONCURRENCY", str(os.cpu_count() or 1)))
+REPO_SYNC_CONCURRENCY = int(os.getenv("REPO_SYNC_CONCURRENCY", "4"))
+# Seconds after which the perm and off-perm inventories are relisted. The temp bucket is relisted on every run.
+INVENTORY_MAX_AGE = float(os.getenv("INVENTORY_MAX_AGE", str(24 * 60 * 60)))
+# Objects being verified are kept in memory up to this size and spooled to disk beyond it
+SPOOL_MEMORY_LIMIT = int(os.getenv("SPOOL_MEMORY_LIMIT", str(8 * 1024**2)))
+# Maximum disk space used by objects spooled at the same time
+SPOOL_DISK_BUDGET = int(os.getenv("SPOOL_DISK_BUDGET", str(4 * 1024**3)))
+
+transfer_schema = {
+    "type": "object",
+    "properties": {
+        # Objects at least this large are uploaded in parts
+        "multipart_threshold": {"type": "integer", "minimum": 1},
+        # S3 requires every part but the last to be at least 5 MiB
+        "multipart_chunksize": {"type": "integer", "minimum": 5 * 1024**2},
+        # Number of parts of an object transferred at the same time
+        "max_concurrency": {"type": "integer", "minimum": 1},
+        # Size of the connection pool to the endpoint
+        "max_pool_connections": {"type": "integer", "minimum": 1},
+    },
+    "additionalProperties": False,
+}
 
 bucket_schema = {
     "type": "object",
@@ -24,6 +74,17 @@ bucket_schema = {
         # one of
         "secret_key": {"type": "string"},
         "secret_key_env_var": {"type": "string"},
+
+        # Whether the SHA-256 checksums recorded by the store can be trusted to verify objects without downloading them.
+        # Off by default, since anyone can upload to the temp bucket. Only enable this for stores that reject uploads
+        # whose content doesn't match the checksum sent with them.
+        "trust_native_checksums": {"type": "boolean"},
+
+        # URL under which the objects of this bucket are served. Defaults to <endpoint_url>/<bucket_name>.
+        "public_url_prefix": {"type": "string"},
+
+        # Multipart transfer settings for uploads and copies to this bucket
+        "transfer": transfer_schema,
     },
     "additionalProperties": False,
     "required": ["endpoint_url", "bucket_name"],
@@ -53,6 +114,7 @@ repo_schema = {
                 "properties": {
                     "url": {"type": "string"},
                     "deploy_key_path": {"type": "string"},
+                    "partial_clone_filter": {"type": ["string", "null"]},
                 },
                 "required": ["url", "deploy_key_path"],
             },
@@ -60,7 +122,10 @@ repo_schema = {
         {
             "if": {"properties": {"type": {"const": "git+https"}}},
             "then": {
-                "properties": {"url": {"type": "string"}},
+                "properties": {
+                    "url": {"type": "string"},
+                    "partial_clone_filter": {"type": ["string", "null"]},
+                },
                 "required": ["url"],
             },
         },
@@ -87,134 +152,488 @@ repo_config_schema = {
 
 
 class Agent:
-    def __init__(self, bucket_config, repo_config, workspace_dir: str):
+    def __init__(
+        self,
+        bucket_config,
+        repo_config,
+        workspace_dir: str,
+        transfer_concurrency: int = TRANSFER_CONCURRENCY,
+        spool_disk_budget: int = SPOOL_DISK_BUDGET,
+        repo_sync_concurrency: int = REPO_SYNC_CONCURRENCY,
+        inventory_max_age: float = INVENTORY_MAX_AGE,
+        hash_concurrency: int = HASH_CONCURRENCY,
+        transfer_max_attempts: int = TRANSFER_MAX_ATTEMPTS,
+        large_transfer_concurrency: int = LARGE_TRANSFER_CONCURRENCY,
+        digest_index: Optional[DigestIndex] = None,
+    ):
         logging.info("Initializing agent")
         validate(bucket_config, schema=bucket_config_schema)
         validate(repo_config, schema=repo_config_schema)
 
-        self.buckets = {
-            name: boto3.resource(
-                "s3",
-                endpoint_url=config["endpoint_url"],
-                aws_access_key_id=config.get("access_key_id") or os.environ[config["access_key_id_env_var"]],
-                aws_secret_access_key=config.get("secret_key") or os.environ[config["secret_key_env_var"]],
-            ).Bucket(config["bucket_name"])
+        self.bucket_config = bucket_config
+        self.repo_config = repo_config
+        self.workspace_dir = Path(workspace_dir)
+        self.scan_cache_dir = self.workspace_dir / "scan-cache"
+        self.state_path = self.workspace_dir / "state.json"
+        # A plan left at this path is treated as an interrupted run and applied by the next run
+        self.plan_path = self.workspace_dir / "plan.json"
+        # Plans written for review are kept apart, so that they are only applied on request
+        self.review_plan_path = self.workspace_dir / "review-plan.json"
+        self.transfer_concurrency = transfer_concurrency
+        self.large_transfer_concurrency = large_transfer_concurrency
+        self.spool_disk_budget = spool_disk_budget
+        self.repo_sync_concurrency = repo_sync_concurrency
+        self.inventory_max_age = inventory_max_age
+        self.hash_concurrency = hash_concurrency
+
+        self.transfer_configs = {
+            name: TransferConfig(
+                **{
+                    setting: value
+                    for setting, value in config.get("transfer", {}).items()
+                    if setting != "max_pool_connections"
+                }
+            )
             for name, config in bucket_config.items()
         }
 
-        self.repo_config = repo_config
-        self.workspace_dir = Path(workspace_dir)
+        # Requests are retried one at a time, and their concurrency backs off when the stores throttle us and
+        # recovers as requests succeed. At most, every small transfer and every part of every large one is in flight.
+        max_part_concurrency = max(config.max_concurrency for config in self.transfer_configs.values())
+        self.retrier = Retrier(
+            AdaptiveLimiter(transfer_concurrency + large_transfer_concurrency * max_part_concurrency),
+            RetryBudget(),
+            transfer_max_attempts,
+        )
 
-    def run(self):
-        logging.info(f"Starting agent with workspace dir {self.workspace_dir}")
         self.workspace_dir.mkdir(exist_ok=True, parents=True)
+        self.inventory = Inventory(self.workspace_dir / "inventory.sqlite3")
+        # Objects referenced by the repos as of the last plan
+        self.desired_objects = None
+        # Where each object is served from, as of the last run, for a resolver to serve. Only kept up to date when
+        # given. Starts from the persisted inventory, so that URIs resolve before the first reconciliation finishes.
+        self.digest_index = digest_index
+        self.refresh_index()
 
-        logging.info(f"Preparing {len(self.repo_config['repos'])} repos")
-        repos = list(clone_repos(self.repo_config, self.workspace_dir))
+        self.clients = ClientPool(self.retrier)
+        self._buckets = None
+        self._buckets_lock = threading.Lock()
 
-        logging.info(f"Extracting WATcloud URIs from {len(repos)} repo(s)")
-        watcloud_uris = list(
-            # sorting to ensure consistent order for testing
-            sorted(flatten([get_watcloud_uris(repo.working_dir) for repo in repos]))
-        )
+    @property
+    def buckets(self):
+        with self._buckets_lock:
+            if self._buckets is None:
+                credentials = {
+                    name: (
+                        config["endpoint_url"],
+                        config.get("access_key_id") or os.environ[config["access_key_id_env_var"]],
+                        config.get("secret_key") or os.environ[config["secret_key_env_var"]],
+                    )
+                    for name, config in self.bucket_config.items()
+                }
+                # Buckets that share a client share its connection pool, so the pool is sized for the largest setting
+                pool_sizes = {}
+                for name, config in self.bucket_config.items():
+                    pool_size = config.get("transfer", {}).get("max_pool_connections", DEFAULT_MAX_POOL_CONNECTIONS)
+                    pool_sizes[credentials[name]] = max(pool_sizes.get(credentials[name], 0), pool_size)
+                self._buckets = {
+                    name: Bucket(
+                        self.clients.get(*credentials[name], pool_sizes[credentials[name]]),
+                        config["bucket_name"],
+                    )
+                    for name, config in self.bucket_config.items()
+                }
+            return self._buckets
 
-        logging.info(f"Found {len(watcloud_uris)} WATcloud URIs:")
-        for uri in watcloud_uris:
-            logging.info(uri)
+    def same_endpoint(self, src, dst):
+        return self.bucket_config[src]["endpoint_url"] == self.bucket_config[dst]["endpoint_url"]
+
+    def trusts_native_checksums(self, name):
+        return self.bucket_config[name].get("trust_native_checksums", False)
+
+    def is_large_move(self, move, size):
+        """
+        Whether moving an object of `size` bytes goes through the large lane, i.e. its bytes pass through the agent
+        in parts, or it is copied in parts.
+        Server-side copies are a single CopyObject up to 5 GiB, whatever the multipart threshold, but promotions
+        that can't be verified with a native checksum are downloaded and hashed in full first.
+        """
+        src, dst = MOVES[move]
+        multipart_threshold = self.transfer_configs[dst].multipart_threshold
+        if move == "temp_to_perm" and not self.trusts_native_checksums("temp") and size >= multipart_threshold:
+            return True
+        if self.same_endpoint(src, dst):
+            return size > MAX_COPY_OBJECT_SIZE
+        return size >= multipart_threshold
+
+    @staticmethod
+    def resumable_upload(checkpoint, obj_key):
+        """
+        Arguments for `upload_stream` that resume the multipart upload of `obj_key` recorded in the checkpoint of
+        a plan, and record a new one. Without a checkpoint, uploads are neither resumed nor recorded.
+        """
+        if checkpoint is None:
+            return {}
+        return {
+            "upload_id": checkpoint.upload_id(obj_key),
+            "on_upload_created": lambda upload_id: checkpoint.record(("uploading", obj_key, upload_id)),
+        }
 
-        desired_perm_objects = set(uri.sha256 for uri in watcloud_uris)
+    def move_object(self, src, dst, obj_key, checkpoint=None):
+        size = self.inventory.size(src, obj_key)
+        if self.same_endpoint(src, dst):
+            etag, last_modified = copy_object(
+                self.buckets[src], self.buckets[dst], obj_key, size, config=self.transfer_configs[dst]
+            )
+            self.inventory.put(dst, obj_key, size, etag, last_modified)
+        else:
+            stream_object(
+                self.buckets[src],
+                self.buckets[dst],
+                obj_key,
+                self.transfer_configs[dst],
+                **self.resumable_upload(checkpoint, obj_key),
+            )
+            self.inventory.put(dst, obj_key, size)
 
+    def promote_object(self, obj_key, spools, hashes, checkpoint=None):
         temp_bucket = self.buckets["temp"]
         perm_bucket = self.buckets["perm"]
-        off_perm_bucket = self.buckets["off-perm"]
+        server_side = self.same_endpoint("temp", "perm")
 
-        temp_objects = set(obj.key for obj in temp_bucket.objects.all())
-        perm_objects = set(obj.key for obj in perm_bucket.objects.all())
-        off_perm_objects = set(obj.key for obj in off_perm_bucket.objects.all())
-        all_objects = temp_objects | perm_objects | off_perm_objects
+        # Verify checksum because we can't trust that the objects in the temp bucket has correct checksums
+        # i.e. attackers can simply use a custom client to upload objects with arbitrary names.
+        head = temp_bucket.client.head_object(Bucket=temp_bucket.name, Key=obj_key, ChecksumMode="ENABLED")
+        size, etag = head["ContentLength"], head["ETag"]
 
-        logging.info(f"Found {len(temp_objects)} objects in temp bucket")
-        logging.info(f"Found {len(perm_objects)} objects in perm bucket")
-        logging.info(f"Found {len(off_perm_objects)} objects in off-perm bucket")
+        # A store that validates the checksum sent with an upload records a checksum that verifies the object
+        # without downloading it. All copies are pinned to the ETag of the version that was verified.
+        if self.trusts_native_checksums("temp") and get_native_sha256(head) == obj_key:
+            logging.debug(f"Verified {obj_key} with the checksum recorded by the temp bucket")
+            if server_side:
+                etag, last_modified = copy_object(
+                    temp_bucket, perm_bucket, obj_key, size, {"CopySourceIfMatch": etag}, self.transfer_configs["perm"]
+                )
+                self.inventory.put("perm", obj_key, size, etag, last_modified)
+            else:
+                body = temp_bucket.client.get_object(Bucket=temp_bucket.name, Key=obj_key, IfMatch=etag)["Body"]
+                upload_stream(
+                    perm_bucket,
+                    obj_key,
+                    body,
+                    size,
+                    self.transfer_configs["perm"],
+                    **self.resumable_upload(checkpoint, obj_key),
+                )
+                self.inventory.put("perm", obj_key, size)
+            return
 
-        errors = []
+        # Otherwise the object is hashed as it streams in. Server-side copies are pinned to the ETag of the version
+        # we hashed, otherwise the bytes are spooled so that only verified bytes are uploaded.
+        # Spool space is reserved before the download starts, for exactly the version we reserved it for.
+        with spools.spool(0 if server_side else size) as spool:
+            response = temp_bucket.client.get_object(Bucket=temp_bucket.name, Key=obj_key, IfMatch=etag)
+            checksum = hashes.hash_stream(response["Body"], None if server_side else spool)
+            if checksum != obj_key:
+                raise ValueError(
+                    f"Checksum mismatch for object {obj_key} in temp bucket! Not uploading to perm bucket."
+                )
 
-        if not desired_perm_objects.issubset(all_objects):
-            errors.append(
-                ValueError(
-                    f"Cannot find the following objects in any bucket: {desired_perm_objects - all_objects}"
+            if server_side:
+                etag, last_modified = copy_object(
+                    temp_bucket, perm_bucket, obj_key, size, {"CopySourceIfMatch": etag}, self.transfer_configs["perm"]
                 )
-            )
+                self.inventory.put("perm", obj_key, size, etag, last_modified)
+            else:
+                spool.seek(0)
+                with hashes.stats.measure("upload", size):
+                    upload_stream(
+                        perm_bucket,
+                        obj_key,
+                        spool,
+                        size,
+                        self.transfer_configs["perm"],
+                        **self.resumable_upload(checkpoint, obj_key),
+                    )
+                self.inventory.put("perm", obj_key, size)
+
+    def apply_move(self, move, obj_key, spools, hashes, deletes, checkpoint):
+        src, dst = MOVES[move]
+        if move == "temp_to_perm":
+            self.promote_object(obj_key, spools, hashes, checkpoint)
+        else:
+            self.move_object(src, dst, obj_key, checkpoint)
+        checkpoint.record(("copied", move, obj_key))
+        deletes[src].add(obj_key)
 
-        # Objects that need to be copied to perm bucket
-        to_perm = desired_perm_objects - perm_objects
-        temp_to_perm = to_perm & temp_objects
-        off_perm_to_perm = to_perm & off_perm_objects
+    def ingest(self, keys):
+        """
+        Promote objects that were just uploaded to the temp bucket, without waiting for the next reconciliation.
+        Only objects referenced as of the last plan are promoted. Anything else is left to the next reconciliation.
+        """
+        if self.desired_objects is None:
+            logging.info("No reconciliation has run yet, leaving new uploads to the first one")
+            return
 
-        # Objects that need to be retired from the perm bucket
-        perm_to_off_perm = perm_objects - desired_perm_objects
+        # Notifications can be delivered more than once, and the same key must not be promoted twice at the same time
+        keys = [
+            obj_key
+            for obj_key in dict.fromkeys(keys)
+            if obj_key in self.desired_objects and self.inventory.size("perm", obj_key) is None
+        ]
+        logging.info(f"Promoting {len(keys)} newly uploaded object(s) from temp to perm bucket")
+        if not keys:
+            return
 
-        # Objects that need to be deleted from the temp bucket (already exists in the perm bucket)
-        # We don't exclude objects from off-perm because the object in temp may exipre later than the object in off-perm
-        delete_from_temp = desired_perm_objects & temp_objects - temp_to_perm
+        errors = []
+        deletes = DeleteBatcher(
+            self.buckets["temp"], errors, on_delete=lambda keys: self.inventory.remove("temp", keys)
+        )
+
+        def ingest_object(obj_key, spools, hashes):
+            self.promote_object(obj_key, spools, hashes)
+            deletes.add(obj_key)
+
+        with (
+            TemporaryDirectory() as spool_dir,
+            HashPipeline(self.hash_concurrency) as hashes,
+            TransferExecutor(self.transfer_concurrency, errors) as executor,
+        ):
+            spools = SpoolManager(spool_dir, self.spool_disk_budget, SPOOL_MEMORY_LIMIT)
+            for obj_key in keys:
+                executor.submit(ingest_object, obj_key, spools, hashes)
+        deletes.flush()
+        # Promoted objects resolve right away, even if others failed
+        self.refresh_index()
+
+        if errors:
+            logging.error("Encountered the following errors during ingestion:")
+            for error in errors:
+                logging.error(error)
+            raise ValueError(f"Encountered {len(errors)} errors during ingestion. Please see above for details.")
+
+    def load_state(self):
+        if not self.state_path.exists():
+            return {}
+        try:
+            return json.loads(self.state_path.read_text())
+        except ValueError as e:
+            logging.warning(f"Ignoring corrupt agent state at {self.state_path}: {e}")
+            return {}
+
+    def save_state(self, state):
+        tmp_path = self.state_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(state))
+        os.replace(tmp_path, self.state_path)
+
+    def run(self):
+        logging.info(f"Starting agent with workspace dir {self.workspace_dir}")
+
+        # A plan left behind by an interrupted run is finished first, skipping the operations that completed
+        if self.plan_path.exists():
+            logging.info(f"Resuming interrupted plan at {self.plan_path}")
+            self.apply()
+
+        try:
+            if self.plan() is not None:
+                self.apply()
+        finally:
+            self.refresh_index()
+
+        logging.info("Agent execution complete")
+
+    def public_url_prefix(self, name):
+        config = self.bucket_config[name]
+        if "public_url_prefix" in config:
+            return config["public_url_prefix"].rstrip("/")
+        return f"{config['endpoint_url'] or 'https://s3.amazonaws.com'}/{config['bucket_name']}"
+
+    def refresh_index(self):
+        """
+        Rebuild the digest index, if there is one, from the inventory. Objects resolve to perm first,
+        like RESOLVER_URL_PREFIXES.
+        """
+        if self.digest_index is None:
+            return
+        self.digest_index.replace(
+            (self.public_url_prefix(name), DigestSet.from_sorted_keys(self.inventory.keys(name)))
+            for name in ["perm", "temp", "off-perm"]
+        )
+
+    def plan(self, plan_path=None):
+        """
+        Work out the moves and deletions needed to reconcile the buckets with the repos and write them to a plan file.
+        Returns the plan, or None if there is nothing to do.
+        """
+        plan_path = Path(plan_path or self.plan_path)
+
+        # Each repo is scanned as soon as it is synced, while the other repos are still syncing
+        logging.info(f"Preparing and extracting WATcloud URIs from {len(self.repo_config['repos'])} repo(s)")
+        watcloud_uris = []
+        for repo in clone_repos(self.repo_config, self.workspace_dir, self.repo_sync_concurrency):
+            watcloud_uris.extend(get_watcloud_uris(repo.working_dir, self.scan_cache_dir))
+        # sorting to ensure consistent order for testing
+        watcloud_uris.sort()
+
+        logging.info(f"Found {len(watcloud_uris)} WATcloud URIs:")
+        for uri in watcloud_uris:
+            logging.info(uri)
+
+        desired_perm_objects = DigestSet.from_keys(uri.sha256 for uri in watcloud_uris)
+        self.desired_objects = desired_perm_objects
+
+        # The temp bucket receives uploads from users, so it is always relisted.
+        # The other buckets are only written to by the agent, which records its writes in the inventory.
+        for name, bucket in self.buckets.items():
+            if name == "temp" or self.inventory.needs_refresh(name, self.inventory_max_age):
+                self.inventory.refresh(name, bucket)
+
+        logging.info(f"Found {self.inventory.count('temp')} objects in temp bucket")
+        logging.info(f"Found {self.inventory.count('perm')} objects in perm bucket")
+        logging.info(f"Found {self.inventory.count('off-perm')} objects in off-perm bucket")
+
+        # If neither the desired objects nor the buckets changed since a run that had nothing to do,
+        # this run has nothing to do either
+        fingerprint = sha256()
+        for obj_key in desired_perm_objects:
+            fingerprint.update(f"{obj_key}\n".encode())
+        for name in ["temp", "perm", "off-perm"]:
+            for obj_key, _size, etag in self.inventory.objects(name):
+                fingerprint.update(f"{name}\0{obj_key}\0{etag}\n".encode())
+        fingerprint = fingerprint.hexdigest()
+
+        state = self.load_state()
+        if state.get("idle_fingerprint") == fingerprint:
+            logging.info("Nothing changed since the last run, which had nothing to do. Skipping reconciliation.")
+            return None
+
+        # The listings are streamed from the inventory in key order and merge-joined with the desired objects
+        result = reconcile(
+            desired_perm_objects,
+            self.inventory.keys("temp"),
+            self.inventory.keys("perm"),
+            self.inventory.keys("off-perm"),
+        )
 
         logging.info(
-            f"{len(desired_perm_objects&perm_objects)}/{len(desired_perm_objects)} objects are already in the perm bucket"
+            f"{result.already_in_perm}/{len(desired_perm_objects)} objects are already in the perm bucket"
         )
-        logging.info(f"Copying {len(temp_to_perm)} object(s) from temp to perm bucket:")
-        for obj_key in temp_to_perm:
+        logging.info(f"Copying {len(result.temp_to_perm)} object(s) from temp to perm bucket:")
+        for obj_key in result.temp_to_perm:
             logging.info(obj_key)
         logging.info(
-            f"Copying {len(off_perm_to_perm)} object(s) from off-perm to perm bucket:"
+            f"Copying {len(result.off_perm_to_perm)} object(s) from off-perm to perm bucket:"
         )
-        for obj_key in off_perm_to_perm:
+        for obj_key in result.off_perm_to_perm:
             logging.info(obj_key)
         logging.info(
-            f"Copying {len(perm_to_off_perm)} object(s) from perm to off-perm bucket:"
+            f"Copying {len(result.perm_to_off_perm)} object(s) from perm to off-perm bucket:"
         )
-        for obj_key in perm_to_off_perm:
+        for obj_key in result.perm_to_off_perm:
             logging.info(obj_key)
         logging.info(
-            f"Deleting {len(delete_from_temp)} redundant object(s) from temp bucket:"
+            f"Deleting {len(result.delete_from_temp)} redundant object(s) from temp bucket:"
         )
-        for obj_key in delete_from_temp:
+        for obj_key in result.delete_from_temp:
             logging.info(obj_key)
 
-        with TemporaryDirectory() as temp_dir:
-            for obj_key in temp_to_perm:
-                temp_bucket.download_file(obj_key, os.path.join(temp_dir, obj_key))
-                # Verify checksum because we can't trust that the objects in the temp bucket has correct checksums
-                # i.e. attackers can simply use a custom client to upload objects with arbitrary names
-                with open(os.path.join(temp_dir, obj_key), "rb") as f:
-                    checksum = sha256(f.read()).hexdigest()
-                if checksum != obj_key:
-                    errors.append(
-                        ValueError(
-                            f"Checksum mismatch for object {obj_key} in temp bucket! Not uploading to perm bucket."
-                        )
-                    )
-                    continue
+        idle = not (
+            result.missing
+            or result.temp_to_perm
+            or result.off_perm_to_perm
+            or result.perm_to_off_perm
+            or result.delete_from_temp
+        )
+        self.save_state({**state, "idle_fingerprint": fingerprint if idle else None})
+        if idle:
+            return None
+
+        logging.info(f"Writing plan to {plan_path}")
+        return write_plan(plan_path, result)
 
-                perm_bucket.upload_file(os.path.join(temp_dir, obj_key), obj_key)
-                temp_bucket.delete_objects(Delete={"Objects": [{"Key": obj_key}]})
+    def apply(self, plan_path=None):
+        """
+        Carry out a plan written by `plan`. Completed operations are checkpointed next to the plan file,
+        so applying a plan again after an interruption only does the remaining operations.
+        The plan and its checkpoint are removed once the plan has been carried out.
+        """
+        plan_path = Path(plan_path or self.plan_path)
+        if not plan_path.exists():
+            # `plan` doesn't write a plan when there is nothing to do
+            logging.info(f"No plan to apply at {plan_path}")
+            return
+        plan = read_plan(plan_path)
+        checkpoint = Checkpoint(checkpoint_path(plan_path))
 
-            for obj_key in off_perm_to_perm:
-                off_perm_bucket.download_file(obj_key, os.path.join(temp_dir, obj_key))
-                perm_bucket.upload_file(os.path.join(temp_dir, obj_key), obj_key)
-                off_perm_bucket.delete_objects(Delete={"Objects": [{"Key": obj_key}]})
+        errors = []
 
-            for obj_key in perm_to_off_perm:
-                perm_bucket.download_file(obj_key, os.path.join(temp_dir, obj_key))
-                off_perm_bucket.upload_file(os.path.join(temp_dir, obj_key), obj_key)
-                perm_bucket.delete_objects(Delete={"Objects": [{"Key": obj_key}]})
+        if plan["missing"]:
+            errors.append(
+                ValueError(
+                    f"Cannot find the following objects in any bucket: {set(plan['missing'])}"
+                )
+            )
 
-            for obj_key in delete_from_temp:
-                temp_bucket.delete_objects(Delete={"Objects": [{"Key": obj_key}]})
+        def on_delete(name, keys):
+            self.inventory.remove(name, keys)
+            checkpoint.record(*(("deleted", name, obj_key) for obj_key in keys))
+
+        # Sources are only deleted after they have been copied, so deletions are batched across all phases
+        deletes = {
+            name: DeleteBatcher(bucket, errors, on_delete=lambda keys, name=name: on_delete(name, keys))
+            for name, bucket in self.buckets.items()
+        }
+
+        stats = StageStats()
+        with (
+            TemporaryDirectory() as spool_dir,
+            HashPipeline(self.hash_concurrency, stats) as hashes,
+            TransferExecutor(self.transfer_concurrency, errors, "transfer") as small_lane,
+            TransferExecutor(self.large_transfer_concurrency, errors, "large-transfer") as large_lane,
+        ):
+            spools = SpoolManager(spool_dir, self.spool_disk_budget, SPOOL_MEMORY_LIMIT)
+
+            # Objects whose bytes move in parts go through their own lane, so that a few huge objects
+            # don't hold up thousands of small ones
+            large_moves = []
+            for move, (src, dst) in MOVES.items():
+                for obj_key in plan[move]:
+                    if ("copied", move, obj_key) not in checkpoint:
+                        size = self.inventory.size(src, obj_key) or 0
+                        if self.is_large_move(move, size):
+                            large_moves.append((size, move, obj_key))
+                        else:
+                            small_lane.submit(self.apply_move, move, obj_key, spools, hashes, deletes, checkpoint)
+                    elif ("deleted", src, obj_key) not in checkpoint:
+                        # Copied before the interruption, but the source was not deleted yet
+                        deletes[src].add(obj_key)
+
+            # Largest first, so that the longest transfers don't start last and leave a long tail
+            logging.info(f"Transferring {len(large_moves)} large object(s) in the large object lane")
+            for _size, move, obj_key in sorted(large_moves, reverse=True):
+                large_lane.submit(self.apply_move, move, obj_key, spools, hashes, deletes, checkpoint)
+
+        for obj_key in plan["delete_from_temp"]:
+            if ("deleted", "temp", obj_key) not in checkpoint:
+                deletes["temp"].add(obj_key)
+
+        for batcher in deletes.values():
+            batcher.flush()
+
+        logging.info("Transfer throughput by stage:")
+        stats.log_summary()
+
+        # The plan has been carried out. Operations that failed are picked up again by the next plan.
+        checkpoint.close()
+        checkpoint.path.unlink()
+        plan_path.unlink()
 
         if errors:
+            # Failed operations may have left the buckets in a state the inventory doesn't know about
+            for name in self.buckets:
+                self.inventory.invalidate(name)
+
             logging.error("Encountered the following errors during execution:")
             for error in errors:
                 logging.error(error)
             raise ValueError(f"Encountered {len(errors)} errors during agent execution. Please see above for details.")
-
-        logging.info("Agent execution complete")
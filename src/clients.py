@@ -0,0 +1,50 @@
+import threading
+from typing import NamedTuple
+
+import boto3
+from botocore.config import Config
+
+# botocore's default connection pool size
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+
+
+class Bucket(NamedTuple):
+    """
+    A bucket and the client used to access it. Unlike boto3 bucket resources, this is safe to share between threads.
+    """
+
+    client: object
+    name: str
+
+
+class ClientPool:
+    """
+    S3 clients keyed by endpoint and credentials.
+    Buckets on the same endpoint with the same credentials share one client, and with it credential resolution
+    and a pool of keep-alive connections. botocore clients are thread-safe, so the clients are also shared between
+    workers. Clients are created on first use.
+    botocore's own retries are turned off, and requests are retried by `retrier` if given.
+    """
+
+    def __init__(self, retrier=None):
+        self.retrier = retrier
+        self._lock = threading.Lock()
+        # Sessions are not thread-safe, so clients are only created while holding the lock
+        self._session = boto3.session.Session()
+        self._clients = {}
+
+    def get(self, endpoint_url, access_key_id, secret_key, max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS):
+        key = (endpoint_url, access_key_id, secret_key)
+        with self._lock:
+            if key not in self._clients:
+                client = self._session.client(
+                    "s3",
+                    endpoint_url=endpoint_url,
+                    aws_access_key_id=access_key_id,
+                    aws_secret_access_key=secret_key,
+                    config=Config(max_pool_connections=max_pool_connections, retries={"total_max_attempts": 1}),
+                )
+                if self.retrier is not None:
+                    self.retrier.attach(client)
+                self._clients[key] = client
+            return self._clients[key]
@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote_plus
+
+# Seconds between reconciliations when nothing triggers one
+DAEMON_INTERVAL = float(os.getenv("DAEMON_INTERVAL", "300"))
+DAEMON_HOST = os.getenv("DAEMON_HOST", "127.0.0.1")
+DAEMON_PORT = int(os.getenv("DAEMON_PORT", "8080"))
+
+
+def parse_notification(notification, bucket_name):
+    """
+    Get the keys of the objects created in `bucket_name` from an S3 event notification.
+    MinIO webhooks send notifications in the same format.
+    """
+    keys = []
+    for record in notification.get("Records", []):
+        if "ObjectCreated" not in record.get("eventName", ""):
+            continue
+        s3 = record.get("s3", {})
+        if s3.get("bucket", {}).get("name") != bucket_name:
+            continue
+        # Keys are URL-encoded in notifications
+        keys.append(unquote_plus(s3.get("object", {}).get("key", "")))
+    return keys
+
+
+class Daemon:
+    """
+    Keeps an agent, along with its clients, repo mirrors and inventory, warm between reconciliations.
+    Reconciles every `interval` seconds, and whenever a POST to /reconcile (e.g. from a git push webhook) triggers it.
+    Reconciliations never overlap: triggers that arrive during a reconciliation cause one more reconciliation after it.
+    Temp bucket notifications POSTed to /notifications are ingested as they arrive, in between reconciliations,
+    so objects that are already referenced are promoted right away. The reconciliations remain the backstop
+    for notifications that are lost.
+    """
+
+    def __init__(self, agent, interval=DAEMON_INTERVAL, host=DAEMON_HOST, port=DAEMON_PORT):
+        self.agent = agent
+        self.interval = interval
+        # Held for the duration of each reconciliation and each ingestion
+        self.reconcile_lock = threading.Lock()
+        self.status = {
+            "reconciliations": 0,
+            "last_started_at": None,
+            "last_finished_at": None,
+            "last_error": None,
+            "ingestions": 0,
+        }
+        self._triggered = threading.Event()
+        self._stopping = threading.Event()
+        # Keys of new temp objects, or None to stop
+        self._uploads = queue.Queue()
+        self.server = ThreadingHTTPServer((host, port), self._make_handler())
+
+    def _make_handler(daemon):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/healthz":
+                    self.send_error(404)
+                    return
+                self._reply(200, daemon.status)
+
+            def do_POST(self):
+                if self.path == "/reconcile":
+                    daemon.trigger()
+                    self._reply(202, {"triggered": True})
+                elif self.path == "/notifications":
+                    try:
+                        notification = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                    except ValueError:
+                        self.send_error(400, "Invalid notification")
+                        return
+                    keys = parse_notification(notification, daemon.agent.bucket_config["temp"]["bucket_name"])
+                    for key in keys:
+                        daemon._uploads.put(key)
+                    self._reply(202, {"queued": len(keys)})
+                else:
+                    self.send_error(404)
+
+            def _reply(self, code, body):
+                payload = json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                logging.debug(f"{self.address_string()} {format % args}")
+
+        return Handler
+
+    def trigger(self):
+        self._triggered.set()
+
+    def reconcile(self):
+        with self.reconcile_lock:
+            self.status["last_started_at"] = time.time()
+            try:
+                self.agent.run()
+                self.status["last_error"] = None
+            except Exception as e:
+                # The daemon keeps going, the next reconciliation retries whatever failed
+                logging.exception(f"Reconciliation failed: {e}")
+                self.status["last_error"] = str(e)
+            self.status["reconciliations"] += 1
+            self.status["last_finished_at"] = time.time()
+
+    def _ingest_forever(self):
+        while True:
+            keys = [self._uploads.get()]
+            # Uploads that arrived in the meantime are promoted in the same batch
+            while keys[-1] is not None and not self._uploads.empty():
+                keys.append(self._uploads.get())
+            stopping = keys[-1] is None
+            keys = [key for key in keys if key is not None]
+
+            if keys:
+                with self.reconcile_lock:
+                    try:
+                        self.agent.ingest(keys)
+                    except Exception as e:
+                        logging.exception(f"Ingestion failed: {e}")
+                    self.status["ingestions"] += 1
+            if stopping:
+                return
+
+    def serve_forever(self):
+        threading.Thread(target=self.server.serve_forever, name="daemon-http", daemon=True).start()
+        ingestion = threading.Thread(target=self._ingest_forever, name="daemon-ingest")
+        ingestion.start()
+        host, port = self.server.server_address[:2]
+        logging.info(f"Reconciling every {self.interval}s and on POST http://{host}:{port}/reconcile")
+        try:
+            while not self._stopping.is_set():
+                self._triggered.clear()
+                self.reconcile()
+                self._triggered.wait(self.interval)
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+            self._uploads.put(None)
+            ingestion.join()
+
+    def stop(self):
+        """
+        Stop after the current reconciliation, if any.
+        """
+        self._stopping.set()
+        self._triggered.set()
@@ -0,0 +1,129 @@
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    bucket TEXT NOT NULL,
+    key TEXT NOT NULL,
+    size INTEGER,
+    etag TEXT,
+    last_modified TEXT,
+    PRIMARY KEY (bucket, key)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS listings (
+    bucket TEXT PRIMARY KEY,
+    listed_at REAL NOT NULL
+);
+"""
+
+
+class Inventory:
+    """
+    Local SQLite copy of the bucket listings.
+    The agent records its own writes here, so buckets that only the agent writes to don't need to be relisted on every run.
+    Safe to use from multiple threads.
+    """
+
+    # Number of rows fetched at a time when iterating over a bucket
+    FETCH_SIZE = 10000
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.executescript(SCHEMA)
+
+    def needs_refresh(self, bucket_name, max_age):
+        with self._lock:
+            row = self._conn.execute("SELECT listed_at FROM listings WHERE bucket = ?", (bucket_name,)).fetchone()
+        return row is None or time.time() - row[0] >= max_age
+
+    def refresh(self, bucket_name, bucket):
+        """
+        Replace the inventory of a bucket with a fresh paginated listing.
+        Each page is staged as it arrives, so the listing is never held in memory, and the inventory of the bucket
+        is only replaced once the whole listing has been staged.
+        """
+        logging.debug(f"Listing {bucket_name} bucket")
+        listed_at = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("CREATE TEMP TABLE IF NOT EXISTS staged_objects AS SELECT * FROM objects WHERE 0")
+            self._conn.execute("DELETE FROM staged_objects WHERE bucket = ?", (bucket_name,))
+
+        for page in bucket.client.get_paginator("list_objects_v2").paginate(Bucket=bucket.name):
+            with self._lock, self._conn:
+                self._conn.executemany(
+                    "INSERT INTO staged_objects VALUES (?, ?, ?, ?, ?)",
+                    (
+                        (bucket_name, obj["Key"], obj["Size"], obj["ETag"], obj["LastModified"].isoformat())
+                        for obj in page.get("Contents", [])
+                    ),
+                )
+
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM objects WHERE bucket = ?", (bucket_name,))
+            self._conn.execute("INSERT INTO objects SELECT * FROM staged_objects WHERE bucket = ?", (bucket_name,))
+            self._conn.execute("DELETE FROM staged_objects WHERE bucket = ?", (bucket_name,))
+            self._conn.execute("INSERT OR REPLACE INTO listings VALUES (?, ?)", (bucket_name, listed_at))
+
+    def invalidate(self, bucket_name):
+        """
+        Force the bucket to be relisted the next time it is needed.
+        """
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM listings WHERE bucket = ?", (bucket_name,))
+
+    def put(self, bucket_name, key, size, etag=None, last_modified=None):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)",
+                (bucket_name, key, size, etag, last_modified and last_modified.isoformat()),
+            )
+
+    def remove(self, bucket_name, keys):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "DELETE FROM objects WHERE bucket = ? AND key = ?", [(bucket_name, key) for key in keys]
+            )
+
+    def _iter_rows(self, query, params):
+        # Rows are fetched in chunks so that a bucket never has to be held in memory at once
+        with self._lock:
+            cursor = self._conn.execute(query, params)
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(self.FETCH_SIZE)
+            if not rows:
+                return
+            yield from rows
+
+    def objects(self, bucket_name):
+        """
+        Yields (key, size, etag) for every object in the bucket, ordered by key like S3 listings.
+        """
+        return self._iter_rows("SELECT key, size, etag FROM objects WHERE bucket = ? ORDER BY key", (bucket_name,))
+
+    def keys(self, bucket_name):
+        """
+        Yields the key of every object in the bucket, ordered by key like S3 listings.
+        """
+        return (key for key, in self._iter_rows("SELECT key FROM objects WHERE bucket = ? ORDER BY key", (bucket_name,)))
+
+    def count(self, bucket_name):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM objects WHERE bucket = ?", (bucket_name,)).fetchone()[0]
+
+    def size(self, bucket_name, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size FROM objects WHERE bucket = ? AND key = ?", (bucket_name, key)
+            ).fetchone()
+        return row and row[0]
+
+    def close(self):
+        self._conn.close()
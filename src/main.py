@@ -1,18 +1,57 @@
 import json
 import os
+import signal
+from pathlib import Path
+from typing import Optional
 from watcloud_utils.typer import app
 from watcloud_utils.logging import set_up_logging
 
 from .agent import Agent
+from .daemon import DAEMON_HOST, DAEMON_INTERVAL, DAEMON_PORT, Daemon
+from .resolver_service import RESOLVER_HOST, RESOLVER_PORT, DigestIndex, ResolverService
 
 WORKSPACE_DIR = os.getenv("WORKSPACE_DIR", "/tmp/workspace")
 
 set_up_logging()
 
+def create_agent(**kwargs):
+    return Agent(json.loads(os.environ["BUCKET_CONFIG"]), json.loads(os.environ["REPO_CONFIG"]), WORKSPACE_DIR, **kwargs)
+
 @app.command()
 def run_agent():
-    agent = Agent(json.loads(os.environ["BUCKET_CONFIG"]), json.loads(os.environ["REPO_CONFIG"]), WORKSPACE_DIR)
+    agent = create_agent()
     agent.run()
 
+# Plans for review default to a separate path from the one `run_agent` resumes, so they are only applied by `apply`
+@app.command()
+def plan(plan_path: Optional[Path] = None):
+    agent = create_agent()
+    agent.plan(plan_path or agent.review_plan_path)
+
+@app.command()
+def apply(plan_path: Optional[Path] = None):
+    agent = create_agent()
+    agent.apply(plan_path or agent.review_plan_path)
+
+@app.command()
+def daemon(
+    interval: float = DAEMON_INTERVAL,
+    host: str = DAEMON_HOST,
+    port: int = DAEMON_PORT,
+    resolver_host: str = RESOLVER_HOST,
+    resolver_port: int = RESOLVER_PORT,
+):
+    # Resolves URIs from the index the agent refreshes after every reconciliation and ingestion
+    digest_index = DigestIndex()
+    agent = create_agent(digest_index=digest_index)
+    resolver = ResolverService(digest_index, resolver_host, resolver_port)
+    resolver.start()
+    agent_daemon = Daemon(agent, interval, host, port)
+    signal.signal(signal.SIGTERM, lambda *_: agent_daemon.stop())
+    try:
+        agent_daemon.serve_forever()
+    finally:
+        resolver.stop()
+
 if __name__ == "__main__":
     app()
\ No newline at end of file
@@ -0,0 +1,93 @@
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+PLAN_VERSION = 1
+
+# Moves between buckets, in the order they are applied: (source bucket, destination bucket)
+MOVES = {
+    "temp_to_perm": ("temp", "perm"),
+    "off_perm_to_perm": ("off-perm", "perm"),
+    "perm_to_off_perm": ("perm", "off-perm"),
+}
+
+
+def write_plan(path: Path, result):
+    """
+    Serialize the moves and deletions computed by `reconcile` to a plan file.
+    """
+    plan = {
+        "version": PLAN_VERSION,
+        "created_at": time.time(),
+        "missing": list(result.missing),
+        "temp_to_perm": list(result.temp_to_perm),
+        "off_perm_to_perm": list(result.off_perm_to_perm),
+        "perm_to_off_perm": list(result.perm_to_off_perm),
+        "delete_from_temp": list(result.delete_from_temp),
+    }
+    path.parent.mkdir(exist_ok=True, parents=True)
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(plan))
+    os.replace(tmp_path, path)
+    return plan
+
+
+def read_plan(path: Path):
+    plan = json.loads(path.read_text())
+    if plan.get("version") != PLAN_VERSION:
+        raise ValueError(f"Unsupported plan version {plan.get('version')} in {path}")
+    return plan
+
+
+def checkpoint_path(plan_path: Path):
+    return plan_path.with_name(plan_path.name + ".checkpoint")
+
+
+class Checkpoint:
+    """
+    Append-only log of the operations of a plan that have completed, so that an interrupted apply can resume.
+    Each line is a completed operation, e.g. "copied temp_to_perm <key>" or "deleted temp <key>".
+    Multipart uploads started by the plan are recorded as "uploading <key> <upload ID>", so that only those are resumed.
+    Safe to use from multiple threads.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._done = set()
+        # key -> ID of the multipart upload of the key started by this plan
+        self._uploads = {}
+        if path.exists():
+            for line in path.read_text().splitlines():
+                # a line cut short by the interruption is ignored
+                if line.count(" ") == 2:
+                    self._add(tuple(line.split(" ")))
+            logging.info(f"Resuming from {len(self._done)} completed operation(s) in {path}")
+        self._file = open(path, "a")
+
+    def _add(self, operation):
+        if operation[0] == "uploading":
+            self._uploads[operation[1]] = operation[2]
+        else:
+            self._done.add(operation)
+
+    def __contains__(self, operation):
+        return operation in self._done
+
+    def upload_id(self, key):
+        with self._lock:
+            return self._uploads.get(key)
+
+    def record(self, *operations):
+        with self._lock:
+            for operation in operations:
+                self._add(operation)
+                self._file.write(" ".join(operation) + "\n")
+            # flushed so that the operations survive the process being killed
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
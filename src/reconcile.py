@@ -0,0 +1,157 @@
+import heapq
+import re
+from dataclasses import dataclass
+from itertools import groupby
+
+DIGEST_SIZE = 32
+
+SHA256_HEX_PATTERN = re.compile(r"[a-f0-9]{64}")
+
+
+class DigestSet:
+    """
+    Sorted set of object keys, stored compactly.
+    SHA-256 hex digests, which is what almost every key is, are packed into 32-byte binaries in one sorted buffer.
+    Any other keys are kept as strings on the side.
+    Lowercase hex sorts the same way as the bytes it encodes, so iteration yields keys in S3 listing order.
+    """
+
+    def __init__(self, packed=b"", others=()):
+        self._packed = bytes(packed)
+        self._others = list(others)
+
+    @classmethod
+    def from_keys(cls, keys):
+        """
+        Builds a DigestSet from keys in any order. Every key is held in memory while they are sorted.
+        """
+        return cls.from_sorted_keys(sorted(set(keys)))
+
+    @classmethod
+    def from_sorted_keys(cls, keys):
+        """
+        Builds a DigestSet from unique keys that are already sorted, e.g. inventory listings, one key at a time.
+        """
+        builder = DigestSetBuilder()
+        for key in keys:
+            builder.append(key)
+        return builder.build()
+
+    def __len__(self):
+        return len(self._packed) // DIGEST_SIZE + len(self._others)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def _digests(self):
+        for i in range(0, len(self._packed), DIGEST_SIZE):
+            yield self._packed[i : i + DIGEST_SIZE].hex()
+
+    def __iter__(self):
+        return heapq.merge(self._digests(), self._others)
+
+    def __contains__(self, key):
+        if not SHA256_HEX_PATTERN.fullmatch(key):
+            return key in self._others
+        digest = bytes.fromhex(key)
+        lo, hi = 0, len(self._packed) // DIGEST_SIZE
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._packed[mid * DIGEST_SIZE : (mid + 1) * DIGEST_SIZE] < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        return self._packed[lo * DIGEST_SIZE : (lo + 1) * DIGEST_SIZE] == digest
+
+    def __repr__(self):
+        return f"DigestSet({set(self)})"
+
+
+class DigestSetBuilder:
+    """
+    Builds a DigestSet from keys appended in sorted order.
+    """
+
+    def __init__(self):
+        self._packed = bytearray()
+        self._others = []
+
+    def append(self, key):
+        if SHA256_HEX_PATTERN.fullmatch(key):
+            self._packed += bytes.fromhex(key)
+        else:
+            self._others.append(key)
+
+    def build(self):
+        return DigestSet(self._packed, self._others)
+
+
+@dataclass
+class Reconciliation:
+    # Desired objects that are not in any bucket
+    missing: DigestSet
+    # Number of desired objects that are already in the perm bucket
+    already_in_perm: int
+    # Objects that need to be copied to the perm bucket
+    temp_to_perm: DigestSet
+    off_perm_to_perm: DigestSet
+    # Objects that need to be retired from the perm bucket
+    perm_to_off_perm: DigestSet
+    # Objects that need to be deleted from the temp bucket (already exists in the perm or off-perm bucket)
+    delete_from_temp: DigestSet
+
+
+def _tag(keys, tag):
+    for key in keys:
+        yield key, tag
+
+
+def reconcile(desired, temp_keys, perm_keys, off_perm_keys):
+    """
+    Computes the moves between buckets with a streaming merge-join.
+    All inputs must be iterables of keys in sorted order, e.g. a DigestSet or an ordered listing.
+    Memory use is independent of the size of the buckets, apart from the results.
+    """
+    tagged = [
+        _tag(desired, "desired"),
+        _tag(temp_keys, "temp"),
+        _tag(perm_keys, "perm"),
+        _tag(off_perm_keys, "off-perm"),
+    ]
+
+    missing = DigestSetBuilder()
+    already_in_perm = 0
+    temp_to_perm = DigestSetBuilder()
+    off_perm_to_perm = DigestSetBuilder()
+    perm_to_off_perm = DigestSetBuilder()
+    delete_from_temp = DigestSetBuilder()
+
+    for key, group in groupby(heapq.merge(*tagged), key=lambda item: item[0]):
+        tags = set(tag for _, tag in group)
+        if "desired" in tags:
+            if "perm" in tags:
+                already_in_perm += 1
+                # We don't exclude objects from off-perm because the object in temp may exipre later than the object in off-perm
+                if "temp" in tags:
+                    delete_from_temp.append(key)
+            elif "off-perm" in tags:
+                # Objects in off-perm were verified when they were promoted, so they are restored from there.
+                # Each key is only moved once, so two moves never write the same key at the same time.
+                off_perm_to_perm.append(key)
+                if "temp" in tags:
+                    delete_from_temp.append(key)
+            elif "temp" in tags:
+                temp_to_perm.append(key)
+            else:
+                missing.append(key)
+        elif "perm" in tags:
+            perm_to_off_perm.append(key)
+
+    return Reconciliation(
+        missing=missing.build(),
+        already_in_perm=already_in_perm,
+        temp_to_perm=temp_to_perm.build(),
+        off_perm_to_perm=off_perm_to_perm.build(),
+        perm_to_off_perm=perm_to_off_perm.build(),
+        delete_from_temp=delete_from_temp.build(),
+    )
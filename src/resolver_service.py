@@ -0,0 +1,123 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+from urllib.parse import parse_qs, urlsplit
+
+from .watcloud_uri import WATcloudURI
+
+RESOLVER_HOST = os.getenv("RESOLVER_HOST", "127.0.0.1")
+RESOLVER_PORT = int(os.getenv("RESOLVER_PORT", "8081"))
+
+
+class DigestIndex:
+    """
+    In-memory index of the objects in each bucket, used to resolve digests to URLs without probing the buckets.
+    Buckets are checked in order, so an object in more than one bucket resolves to the first one.
+    Safe to use from multiple threads.
+    """
+
+    def __init__(self):
+        # [(URL prefix, DigestSet of the objects in the bucket)]
+        self._buckets = []
+        self._lock = threading.Lock()
+
+    def replace(self, buckets):
+        with self._lock:
+            self._buckets = list(buckets)
+
+    def lookup(self, sha256):
+        with self._lock:
+            buckets = self._buckets
+        for prefix, keys in buckets:
+            if sha256 in keys:
+                return f"{prefix}/{sha256}"
+        return None
+
+
+class ResolverService:
+    """
+    Small HTTP service that resolves WATcloud URIs from a DigestIndex, on its own asyncio event loop thread.
+    GET /resolve?uri=<WATcloud URI> responds with the URL as JSON, and with a redirect to it when `redirect` is set.
+    """
+
+    def __init__(self, index, host=RESOLVER_HOST, port=RESOLVER_PORT):
+        self.index = index
+        self.host = host
+        self.port = port
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            # Headers are not needed
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            status, headers, body = self._respond(request_line.decode("latin-1").split())
+        except Exception as e:
+            logging.exception(f"Failed to handle resolver request: {e}")
+            status, headers, body = "500 Internal Server Error", {}, {"error": "Internal server error"}
+
+        payload = json.dumps(body).encode()
+        headers = {**headers, "Content-Type": "application/json", "Content-Length": len(payload), "Connection": "close"}
+        writer.write(f"HTTP/1.1 {status}\r\n".encode())
+        writer.write("".join(f"{name}: {value}\r\n" for name, value in headers.items()).encode())
+        writer.write(b"\r\n" + payload)
+        await writer.drain()
+        writer.close()
+
+    def _respond(self, request_line):
+        if len(request_line) != 3 or request_line[0] != "GET":
+            return "405 Method Not Allowed", {}, {"error": "Only GET requests are supported"}
+        target = urlsplit(request_line[1])
+        if target.path != "/resolve":
+            return "404 Not Found", {}, {"error": "Not found"}
+
+        query = parse_qs(target.query, keep_blank_values=True)
+        try:
+            uri = WATcloudURI(query.get("uri", [""])[0])
+        except ValueError as e:
+            return "400 Bad Request", {}, {"error": str(e)}
+
+        url = self.index.lookup(uri.sha256)
+        if url is None:
+            return "404 Not Found", {}, {"error": "Asset not found."}
+        if "redirect" in query:
+            return "302 Found", {"Location": url}, {"url": url}
+        return "200 OK", {}, {"url": url}
+
+    def start(self):
+        ready = threading.Event()
+        errors = []
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            try:
+                self._server = self._loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port))
+            except Exception as e:
+                errors.append(e)
+                self._loop.close()
+                ready.set()
+                return
+            self.port = self._server.sockets[0].getsockname()[1]
+            logging.info(f"Resolving WATcloud URIs on http://{self.host}:{self.port}/resolve")
+            ready.set()
+            try:
+                self._loop.run_until_complete(self._server.serve_forever())
+            except asyncio.CancelledError:
+                pass
+            finally:
+                self._loop.close()
+
+        self._thread = threading.Thread(target=run, name="resolver", daemon=True)
+        self._thread.start()
+        ready.wait()
+        if errors:
+            raise errors[0]
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._server.close)
+        self._thread.join()
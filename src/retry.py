@@ -0,0 +1,162 @@
+import logging
+import random
+import threading
+
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError, IncompleteReadError
+
+# Error codes S3 and S3-compatible stores (e.g. Ceph RGW) use to ask clients to slow down
+THROTTLING_ERROR_CODES = {"SlowDown", "Throttling", "ThrottlingException", "RequestLimitExceeded", "TooManyRequests"}
+THROTTLING_STATUS_CODES = {429, 503}
+
+# Errors that are likely to go away on their own
+TRANSIENT_ERROR_CODES = {"InternalError", "RequestTimeout", "ServiceUnavailable"}
+TRANSIENT_STATUS_CODES = {500, 502, 504}
+
+
+def _error_code(e):
+    return e.response.get("Error", {}).get("Code"), e.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+
+
+def is_throttling_error(e):
+    if not isinstance(e, ClientError):
+        return False
+    code, status = _error_code(e)
+    return code in THROTTLING_ERROR_CODES or status in THROTTLING_STATUS_CODES
+
+
+def is_retryable_error(e):
+    # Connection resets, timeouts and responses cut short
+    if isinstance(e, (ConnectionError, HTTPClientError, IncompleteReadError)):
+        return True
+    if not isinstance(e, ClientError):
+        return False
+    code, status = _error_code(e)
+    return is_throttling_error(e) or code in TRANSIENT_ERROR_CODES or status in TRANSIENT_STATUS_CODES
+
+
+class AdaptiveLimiter:
+    """
+    Limits the number of operations running at the same time, adapting the limit with AIMD:
+    the limit grows by one for every `limit` operations that succeed, and halves when the store throttles us.
+    Throttling errors from operations that started before the last decrease don't decrease the limit again,
+    so a burst of errors from one overload only halves the limit once.
+    """
+
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max_limit)
+        self._running = 0
+        self._generation = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Wait for a slot. Returns a token to pass to `throttled`.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._running < int(self.limit))
+            self._running += 1
+            return self._generation
+
+    def release(self):
+        with self._condition:
+            self._running -= 1
+            self._condition.notify_all()
+
+    def succeeded(self):
+        with self._condition:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def throttled(self, token):
+        with self._condition:
+            if token != self._generation:
+                return
+            self._generation += 1
+            self.limit = max(self.min_limit, self.limit / 2)
+            logging.warning(f"Throttled by the store, reducing transfer concurrency to {int(self.limit)}")
+
+
+class RetryBudget:
+    """
+    Caps retries across all operations to a fraction of the operations that succeeded, starting from a small
+    reserve, so that a store that is down doesn't get hit with every operation `max_attempts` times.
+    """
+
+    def __init__(self, ratio=0.2, reserve=10, max_tokens=100):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = float(reserve)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self._tokens + self.ratio, self.max_tokens)
+
+    def withdraw(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class Retrier:
+    """
+    Retries the requests of S3 clients it is attached to, in place of botocore's own retries.
+    Each request attempt runs within the concurrency of an AdaptiveLimiter, and transient failures are retried
+    with exponential backoff and full jitter, as long as the shared RetryBudget allows.
+    The last error is raised by the client once a request runs out of attempts or budget.
+    """
+
+    def __init__(self, limiter, budget, max_attempts, base_delay=0.5, max_delay=30.0):
+        self.limiter = limiter
+        self.budget = budget
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # The limiter token of the attempt in flight on each thread. Attempts are sent and checked on the same thread.
+        self._local = threading.local()
+
+    def attach(self, client):
+        """
+        Route the requests of `client` through this retrier. The client should be created with botocore's retries
+        turned off (total_max_attempts=1), otherwise botocore retries before the retrier sees the error.
+        """
+        client.meta.events.register("before-send.s3", self._before_send)
+        client.meta.events.register("needs-retry.s3", self._needs_retry)
+
+    def _release(self):
+        token, self._local.token = getattr(self._local, "token", None), None
+        if token is not None:
+            self.limiter.release()
+        return token
+
+    def _before_send(self, **kwargs):
+        # An attempt whose outcome was never checked, e.g. because an earlier handler failed, gives up its slot
+        self._release()
+        self._local.token = self.limiter.acquire()
+
+    def _needs_retry(self, response, attempts, caught_exception, operation, **kwargs):
+        token = self._release()
+
+        error = caught_exception
+        if error is None:
+            http_response, parsed = response
+            if http_response.status_code < 300:
+                self.limiter.succeeded()
+                self.budget.deposit()
+                return None
+            error = ClientError(parsed, operation.name)
+
+        if token is not None and is_throttling_error(error):
+            self.limiter.throttled(token)
+        if not is_retryable_error(error) or attempts >= self.max_attempts:
+            return None
+        if not self.budget.withdraw():
+            logging.warning("Retry budget exhausted, not retrying")
+            return None
+        logging.warning(f"Attempt {attempts}/{self.max_attempts} of {operation.name} failed, retrying: {error}")
+        # botocore sleeps for the returned number of seconds before retrying
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempts))
@@ -0,0 +1,47 @@
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Optional
+
+
+class ScanCache:
+    """
+    Persistent record of the raw WATcloud URIs found in each blob reachable from the ref tips of a repo.
+    Blobs are immutable, so each one only needs to be scanned once. When no ref has moved since the
+    last scan, the repo doesn't need to be looked at at all.
+    """
+
+    def __init__(self, path: Optional[Path] = None):
+        self.path = path
+        # ref name -> object name of the ref tip
+        self.tips = {}
+        # blob object name -> raw URIs found in the blob
+        self.blobs = {}
+
+        if path is not None and path.exists():
+            try:
+                data = json.loads(path.read_text())
+                self.tips = data["tips"]
+                self.blobs = data["blobs"]
+            except (ValueError, KeyError) as e:
+                logging.warning(f"Ignoring corrupt scan cache at {path}: {e}")
+
+    def update(self, tips, blobs):
+        """
+        Record the current ref tips and the URIs of all blobs reachable from them.
+        Blobs that are no longer reachable are dropped.
+        """
+        self.tips = dict(tips)
+        self.blobs = {oid: sorted(uris) for oid, uris in blobs.items()}
+
+    def uris(self):
+        return set(uri for uris in self.blobs.values() for uri in uris)
+
+    def save(self):
+        if self.path is None:
+            return
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps({"tips": self.tips, "blobs": self.blobs}))
+        os.replace(tmp_path, self.path)
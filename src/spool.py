@@ -0,0 +1,47 @@
+import logging
+import threading
+from contextlib import contextmanager
+from tempfile import SpooledTemporaryFile
+
+
+class SpoolManager:
+    """
+    Hands out per-object spool files while keeping the disk used by in-flight objects within `disk_budget` bytes.
+    Objects up to `memory_limit` bytes are kept in memory and do not count towards the budget.
+    When the budget is used up, new spools block until earlier ones are released.
+    """
+
+    def __init__(self, directory, disk_budget, memory_limit):
+        self.directory = directory
+        self.disk_budget = disk_budget
+        self.memory_limit = memory_limit
+        self._used = 0
+        self._condition = threading.Condition()
+
+    def _reserve(self, size):
+        with self._condition:
+            # An object larger than the whole budget is let through once nothing else is spooled,
+            # otherwise it would wait forever
+            while self._used and self._used + size > self.disk_budget:
+                logging.debug(f"Waiting for {size} bytes of spool space ({self._used}/{self.disk_budget} bytes used)")
+                self._condition.wait()
+            self._used += size
+
+    def _release(self, size):
+        with self._condition:
+            self._used -= size
+            self._condition.notify_all()
+
+    @contextmanager
+    def spool(self, size):
+        """
+        Reserve space for an object of `size` bytes and yield a file to spool it to.
+        The file is deleted and the space is released when the context exits.
+        """
+        disk_size = size if size > self.memory_limit else 0
+        self._reserve(disk_size)
+        try:
+            with SpooledTemporaryFile(max_size=self.memory_limit, dir=self.directory) as f:
+                yield f
+        finally:
+            self._release(disk_size)
@@ -0,0 +1,335 @@
+import base64
+import logging
+import queue
+import time
+from contextlib import contextmanager
+from hashlib import md5, sha256
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+# CopyObject can only copy objects up to 5 GiB in a single request.
+# Larger objects must be copied part by part with UploadPartCopy.
+# https://docs.aws.amazon.com/AmazonS3/latest/API/API_CopyObject.html
+MAX_COPY_OBJECT_SIZE = 5 * 1024**3
+
+# DeleteObjects accepts at most 1000 keys per request.
+# https://docs.aws.amazon.com/AmazonS3/latest/API/API_DeleteObjects.html
+MAX_DELETE_BATCH_SIZE = 1000
+
+HASH_CHUNK_SIZE = 1024**2
+
+# Number of chunks of an object that can be downloaded ahead of its hasher
+HASH_QUEUE_DEPTH = 8
+
+# Parts copied with UploadPartCopy don't pass through the agent, so they can be much larger than uploaded parts
+COPY_CHUNK_SIZE = 512 * 1024**2
+
+
+def copy_object(src_bucket, dst_bucket, key, size, extra_args=None, config=None):
+    """
+    Copy an object between two buckets on the same endpoint without moving the data through the agent.
+    Objects over 5 GiB are copied with multipart UploadPartCopy, with the concurrency of `config`.
+    Returns the ETag and last modified time of the new object.
+    """
+    logging.debug(f"Server-side copying {key} from {src_bucket.name} to {dst_bucket.name}")
+    copy_source = {"Bucket": src_bucket.name, "Key": key}
+    if size <= MAX_COPY_OBJECT_SIZE:
+        response = dst_bucket.client.copy_object(
+            Bucket=dst_bucket.name, Key=key, CopySource=copy_source, **(extra_args or {})
+        )
+        return response["CopyObjectResult"]["ETag"], response["CopyObjectResult"]["LastModified"]
+
+    copy_config = TransferConfig(
+        multipart_threshold=MAX_COPY_OBJECT_SIZE,
+        multipart_chunksize=COPY_CHUNK_SIZE,
+        max_concurrency=(config or TransferConfig()).max_concurrency,
+    )
+    dst_bucket.client.copy(copy_source, dst_bucket.name, key, ExtraArgs=extra_args, Config=copy_config)
+    # Multipart copies don't return the resulting object
+    head = dst_bucket.client.head_object(Bucket=dst_bucket.name, Key=key)
+    return head["ETag"], head["LastModified"]
+
+
+class StageStats:
+    """
+    Bytes processed and time spent in each stage of the transfers, summed across workers.
+    Safe to use from multiple threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started_at = time.monotonic()
+        # stage -> [bytes, seconds]
+        self._stages = {}
+
+    def add(self, stage, nbytes, seconds):
+        with self._lock:
+            totals = self._stages.setdefault(stage, [0, 0.0])
+            totals[0] += nbytes
+            totals[1] += seconds
+
+    @contextmanager
+    def measure(self, stage, nbytes):
+        start = time.monotonic()
+        yield
+        self.add(stage, nbytes, time.monotonic() - start)
+
+    def log_summary(self):
+        elapsed = time.monotonic() - self._started_at
+        with self._lock:
+            stages = dict(self._stages)
+        for stage, (nbytes, seconds) in stages.items():
+            mib = nbytes / 1024**2
+            logging.info(
+                f"{stage}: {mib:.1f} MiB in {seconds:.1f}s of worker time "
+                f"({mib / max(seconds, 1e-9):.1f} MiB/s per worker, {mib / max(elapsed, 1e-9):.1f} MiB/s overall)"
+            )
+
+
+class HashPipeline:
+    """
+    Hashes objects on a pool of hash workers, separate from the transfer workers that download them.
+    Each object is hashed by one hash worker fed through a bounded queue, so downloading an object overlaps with
+    hashing its earlier chunks, and different objects are hashed on different cores.
+    hashlib releases the GIL while hashing large buffers, so threads are enough to use every core.
+    """
+
+    def __init__(self, max_workers, stats=None):
+        self.stats = stats or StageStats()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hash")
+
+    def _hash(self, chunks):
+        digest = sha256()
+        for chunk in iter(chunks.get, None):
+            with self.stats.measure("hash", len(chunk)):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def hash_stream(self, stream, sink=None):
+        """
+        Compute the SHA-256 hex digest of a stream, optionally writing the chunks to `sink`.
+        """
+        chunks = queue.Queue(maxsize=HASH_QUEUE_DEPTH)
+        digest = self._executor.submit(self._hash, chunks)
+        try:
+            while True:
+                start = time.monotonic()
+                chunk = stream.read(HASH_CHUNK_SIZE)
+                self.stats.add("download", len(chunk), time.monotonic() - start)
+                if not chunk:
+                    break
+                # Blocks when the hasher falls behind, so at most HASH_QUEUE_DEPTH chunks are held per object
+                chunks.put(chunk)
+                if sink is not None:
+                    with self.stats.measure("spool", len(chunk)):
+                        sink.write(chunk)
+        finally:
+            chunks.put(None)
+        return digest.result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._executor.shutdown()
+
+
+def get_native_sha256(head):
+    """
+    Get the SHA-256 hex digest of a whole object from a HeadObject response requested with ChecksumMode=ENABLED.
+    Returns None if the store didn't record one. Multipart uploads have composite checksums ("<checksum>-<parts>"),
+    which are checksums of the part checksums rather than of the object, so those are not used either.
+    """
+    checksum = head.get("ChecksumSHA256")
+    if not checksum or "-" in checksum or head.get("ChecksumType", "FULL_OBJECT") != "FULL_OBJECT":
+        return None
+    return base64.b64decode(checksum).hex()
+
+
+def read_exactly(stream, size):
+    """
+    Read `size` bytes from a stream, or fewer only at the end of the stream.
+    """
+    chunks = []
+    while size > 0:
+        chunk = stream.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def list_parts(client, bucket_name, key, upload_id):
+    """
+    Returns the parts uploaded so far by a multipart upload, or None if the upload no longer exists,
+    i.e. it was completed or aborted.
+    """
+    parts = {}
+    try:
+        for page in client.get_paginator("list_parts").paginate(Bucket=bucket_name, Key=key, UploadId=upload_id):
+            for part in page.get("Parts", []):
+                parts[part["PartNumber"]] = part
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") == "NoSuchUpload":
+            return None
+        raise
+    return parts
+
+
+def upload_stream(bucket, key, stream, size, config, upload_id=None, on_upload_created=None):
+    """
+    Upload `size` bytes from a stream with the multipart settings of `config`.
+    The multipart upload `upload_id`, e.g. one recorded by an interrupted run, is resumed if it still exists:
+    parts it already has with the same content are not uploaded again. Uploads started by anyone else are never
+    resumed, since they may still be in progress. `on_upload_created` is called with the ID of a new multipart
+    upload, so that it can be recorded. Uploads that are never resumed should be cleaned up with a lifecycle rule
+    (AbortIncompleteMultipartUpload).
+    """
+    if size < config.multipart_threshold:
+        bucket.client.upload_fileobj(stream, bucket.name, key, Config=config)
+        return
+
+    client = bucket.client
+    chunk_size = config.multipart_chunksize
+    uploaded_parts = None
+    if upload_id is not None:
+        uploaded_parts = list_parts(client, bucket.name, key, upload_id)
+    if uploaded_parts is None:
+        uploaded_parts = {}
+        upload_id = client.create_multipart_upload(Bucket=bucket.name, Key=key)["UploadId"]
+        if on_upload_created is not None:
+            on_upload_created(upload_id)
+    else:
+        # The parts only line up if the object is split the same way as before
+        if 1 in uploaded_parts:
+            chunk_size = uploaded_parts[1]["Size"]
+        logging.info(
+            f"Resuming multipart upload of {key} to {bucket.name} with {len(uploaded_parts)} part(s) already uploaded"
+        )
+
+    # Bounds the number of chunks held in memory
+    slots = threading.Semaphore(config.max_concurrency)
+
+    def upload_part(part_number, chunk):
+        try:
+            return client.upload_part(
+                Bucket=bucket.name, Key=key, UploadId=upload_id, PartNumber=part_number, Body=chunk
+            )["ETag"]
+        finally:
+            slots.release()
+
+    etags = {}
+    with ThreadPoolExecutor(max_workers=config.max_concurrency, thread_name_prefix="upload") as executor:
+        part_number = 0
+        for chunk in iter(lambda: read_exactly(stream, chunk_size), b""):
+            part_number += 1
+            uploaded = uploaded_parts.get(part_number)
+            if uploaded and uploaded["Size"] == len(chunk) and uploaded["ETag"].strip('"') == md5(chunk).hexdigest():
+                etags[part_number] = uploaded["ETag"]
+                continue
+            slots.acquire()
+            etags[part_number] = executor.submit(upload_part, part_number, chunk)
+
+    parts = [
+        {"PartNumber": number, "ETag": etag if isinstance(etag, str) else etag.result()}
+        for number, etag in sorted(etags.items())
+    ]
+    client.complete_multipart_upload(
+        Bucket=bucket.name, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts}
+    )
+
+
+def stream_object(src_bucket, dst_bucket, key, config, upload_id=None, on_upload_created=None):
+    """
+    Copy an object between two buckets on different endpoints by streaming it through the agent.
+    Multipart uploads are resumed and recorded like in `upload_stream`.
+    """
+    logging.debug(f"Streaming {key} from {src_bucket.name} to {dst_bucket.name}")
+    response = src_bucket.client.get_object(Bucket=src_bucket.name, Key=key)
+    upload_stream(
+        dst_bucket, key, response["Body"], response["ContentLength"], config, upload_id, on_upload_created
+    )
+
+
+class TransferExecutor:
+    """
+    Runs transfer operations on a bounded pool of worker threads.
+    Exceptions raised by the operations are collected into `errors` instead of being raised.
+    """
+
+    def __init__(self, max_workers, errors, thread_name_prefix="transfer"):
+        self.errors = errors
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._futures = []
+
+    def submit(self, fn, *args, **kwargs):
+        self._futures.append(self._executor.submit(fn, *args, **kwargs))
+
+    def wait(self):
+        for future in as_completed(self._futures):
+            if future.exception() is not None:
+                self.errors.append(future.exception())
+        self._futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wait()
+        self._executor.shutdown()
+
+
+class DeleteBatcher:
+    """
+    Collects keys to delete from a bucket and deletes them with DeleteObjects, up to 1000 keys per request.
+    Keys that fail to be deleted are collected into `errors`, and `on_delete` is called with the keys that were deleted.
+    """
+
+    def __init__(self, bucket, errors, on_delete=None, batch_size=MAX_DELETE_BATCH_SIZE):
+        self.client = bucket.client
+        self.bucket_name = bucket.name
+        self.errors = errors
+        self.on_delete = on_delete
+        self.batch_size = batch_size
+        self._keys = []
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        with self._lock:
+            self._keys.append(key)
+            if len(self._keys) < self.batch_size:
+                return
+            batch, self._keys = self._keys, []
+        self._delete(batch)
+
+    def flush(self):
+        with self._lock:
+            batch, self._keys = self._keys, []
+        if batch:
+            self._delete(batch)
+
+    def _delete(self, keys):
+        logging.debug(f"Deleting {len(keys)} object(s) from {self.bucket_name}")
+        try:
+            response = self.client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True},
+            )
+        except Exception as e:
+            self.errors.append(e)
+            return
+
+        failed = set()
+        for error in response.get("Errors", []):
+            failed.add(error["Key"])
+            self.errors.append(
+                ValueError(
+                    f"Failed to delete object {error['Key']} from bucket {self.bucket_name}: {error['Code']} {error['Message']}"
+                )
+            )
+        if self.on_delete is not None:
+            self.on_delete([key for key in keys if key not in failed])
@@ -1,102 +1,294 @@
+import contextlib
 import itertools
 import json
 import logging
+import multiprocessing
 import os
+import re
+import subprocess
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from enum import Enum
+from hashlib import sha256
 from pathlib import Path
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, TemporaryFile
+from typing import Optional
 
 from watcloud_utils.typer import app
-from git import GitCommandError, Repo
+from git import Git, Repo
 
-from .watcloud_uri import WATcloudURI
+from .scan_cache import ScanCache
+from .watcloud_uri import parse_many
 
 
 flatten = itertools.chain.from_iterable
 
+WATCLOUD_URI_PATTERN = re.compile(rb"watcloud://[^\"' \n]*")
 
-def clone_repos(repo_config, workspace_dir):
-    for config in repo_config["repos"]:
-        if config["type"] == "local":
-            repo = Repo(config["path"])
-            logging.info(f"Using existing repo at {repo.working_dir}")
-        elif config["type"] == "git+https":
-            repo_url = config["url"]
-            repo_path = workspace_dir / repo_url
-
-            if repo_path.exists():
-                logging.debug(
-                    f"Path {repo_path} already exists. Pulling latest changes."
-                )
-                repo = Repo(repo_path)
-                repo.remote().pull()
-                logging.info(f"Pulled latest changes to {repo.working_dir}")
-            else:
-                logging.debug(f"Path {repo_path} does not exist. Cloning repo.")
-                repo = Repo.clone_from(repo_url, repo_path)
-                logging.info(f"Cloned {repo_url} to {repo.working_dir}")
-        elif config["type"] == "git+ssh":
-            repo_url = config["url"]
-            deploy_key_path = config["deploy_key_path"]
-
-            # Temporary file is required to handle ssh key permissions.
-            # NamedTemporaryFile is always created with mode 0600:
-            # https://stackoverflow.com/a/10541972
-            with NamedTemporaryFile() as deploy_key_file:
-                logging.debug(f"Copying deploy key from {deploy_key_path} to {deploy_key_file.name}")
-                deploy_key_file.write(Path(deploy_key_path).read_bytes())
-                deploy_key_file.flush()
-        
-                repo_path = workspace_dir / repo_url
-
-                if repo_path.exists():
-                    logging.debug(f"Path {repo_path} already exists. Pulling latest changes.")
-                    repo = Repo(repo_path)
-                    repo.remote().pull(env={"GIT_SSH_COMMAND": f"ssh -i {deploy_key_file.name}"})
-                    logging.info(f"Pulled latest changes to {repo.working_dir}")
-                else:
-                    logging.debug(f"Path {repo_path} does not exist. Cloning repo.")
-                    repo = Repo.clone_from(repo_url, repo_path, env={"GIT_SSH_COMMAND": f"ssh -i {deploy_key_file.name}"})
-                    logging.info(f"Cloned {repo_url} to {repo.working_dir}")
+# Only branches and tags are mirrored. Other refs, e.g. GitHub's refs/pull/*, are not scanned.
+MIRROR_REFSPECS = ["+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*"]
+# History is never scanned, so mirrors are blobless and only fetch the blobs at the ref tips
+PARTIAL_CLONE_FILTER = "blob:none"
+# Written to a mirror's git dir once a sync has fetched every blob at the ref tips, and removed before its refs move
+SYNC_COMPLETE_MARKER = "watcloud-sync-complete"
+# Blobs to scan are split into shards of this many blobs, which are scanned in parallel processes
+SCAN_SHARD_SIZE = int(os.getenv("SCAN_SHARD_SIZE", "5000"))
+SCAN_PROCESSES = int(os.getenv("SCAN_PROCESSES", str(os.cpu_count() or 1)))
+
+
+def sync_mirror(repo_url, repo_path, partial_clone_filter, env=None):
+    """
+    Clones or fetches a bare partial-clone mirror of the branches and tags of a remote repo.
+    Only blobs in the trees of the branches and tags are fetched, since that is all that gets scanned.
+    """
+    if repo_path.exists():
+        repo = Repo(repo_path)
+        marker = Path(repo.git_dir) / SYNC_COMPLETE_MARKER
+        # The mirror's refs are exactly the remote tips recorded by the last sync
+        if get_remote_ref_tips(repo_url, env) == get_ref_tips(repo):
+            if marker.exists():
+                logging.info(f"No refs have moved in {repo_url} since the last sync. Skipping sync.")
+                return repo
+            # The last sync was interrupted before its blobs were fetched
+            logging.info(f"No refs have moved in {repo_url} since the last sync, which did not complete")
         else:
-            raise ValueError(f"Unsupported repo type '{config['type']}'")
+            logging.debug(f"Path {repo_path} already exists. Fetching latest changes.")
+            marker.unlink(missing_ok=True)
+            repo.git.fetch("--prune", "origin", *MIRROR_REFSPECS, env=env)
+            logging.info(f"Fetched latest changes to {repo.git_dir}")
+    else:
+        logging.debug(f"Path {repo_path} does not exist. Cloning repo.")
+        repo = Repo.clone_from(repo_url, repo_path, env=env, bare=True, filter=partial_clone_filter)
+        logging.info(f"Cloned {repo_url} to {repo.git_dir}")
+
+    fetch_missing_blobs(repo, env)
+    (Path(repo.git_dir) / SYNC_COMPLETE_MARKER).touch()
+    return repo
+
+
+def sync_repo(config, workspace_dir):
+    if config["type"] == "local":
+        repo = Repo(config["path"])
+        logging.info(f"Using existing repo at {repo.working_dir}")
+    elif config["type"] == "git+https":
+        repo_url = config["url"]
+        repo_path = workspace_dir / "mirrors" / repo_url
+        partial_clone_filter = config.get("partial_clone_filter", PARTIAL_CLONE_FILTER)
+
+        repo = sync_mirror(repo_url, repo_path, partial_clone_filter)
+    elif config["type"] == "git+ssh":
+        repo_url = config["url"]
+        repo_path = workspace_dir / "mirrors" / repo_url
+        partial_clone_filter = config.get("partial_clone_filter", PARTIAL_CLONE_FILTER)
+        deploy_key_path = config["deploy_key_path"]
+
+        # Temporary file is required to handle ssh key permissions.
+        # NamedTemporaryFile is always created with mode 0600:
+        # https://stackoverflow.com/a/10541972
+        # Each sync gets its own copy, so repos synced in parallel never share a key file.
+        with NamedTemporaryFile() as deploy_key_file:
+            logging.debug(f"Copying deploy key from {deploy_key_path} to {deploy_key_file.name}")
+            deploy_key_file.write(Path(deploy_key_path).read_bytes())
+            deploy_key_file.flush()
+
+            repo = sync_mirror(
+                repo_url,
+                repo_path,
+                partial_clone_filter,
+                env={"GIT_SSH_COMMAND": f"ssh -i {deploy_key_file.name}"},
+            )
+    else:
+        raise ValueError(f"Unsupported repo type '{config['type']}'")
+
+    return repo
+
+
+def clone_repos(repo_config, workspace_dir, max_workers=1):
+    """
+    Clones or pulls the configured repos on a pool of `max_workers` threads.
+    Repos are yielded as soon as they are ready, in the order they finish.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="repo-sync") as executor:
+        futures = [executor.submit(sync_repo, config, workspace_dir) for config in repo_config["repos"]]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def get_ref_tips(repo):
+    """
+    Returns a mapping from ref name to the object name of the ref tip.
+    """
+    out = repo.git.for_each_ref("--format=%(refname) %(objectname)")
+    return dict(line.split(" ", 1) for line in out.splitlines())
+
+
+def get_remote_ref_tips(repo_url, env=None):
+    """
+    Returns a mapping from branch and tag name to the object name of the tip in a remote repo, like `get_ref_tips`.
+    """
+    # --refs omits the peeled "^{}" entries of annotated tags
+    out = Git().ls_remote("--heads", "--tags", "--refs", repo_url, env=env)
+    return {ref: oid for oid, ref in (line.split("\t", 1) for line in out.splitlines())}
+
+
+def list_blobs(repo, revs, missing_only=False):
+    """
+    Returns the object names of the unique blobs in the trees of the given revs.
+    With `missing_only`, returns only those that are not present locally, e.g. not yet fetched into a partial clone.
+    """
+    if not revs:
+        return []
+    out = repo.git.rev_list(
+        "--objects",
+        "--no-walk",
+        "--no-object-names",
+        "--filter=object:type=blob",
+        "--filter-provided-objects",
+        # missing objects are printed with a "?" prefix instead of being fetched one at a time
+        "--missing=print",
+        *revs,
+    )
+    if missing_only:
+        return [line[1:] for line in out.split() if line.startswith("?")]
+    return [line.lstrip("?") for line in out.split()]
+
+
+def fetch_missing_blobs(repo, env=None):
+    """
+    Fetches the blobs at the ref tips of a partial clone that are not present locally, in a single request.
+    """
+    missing = list_blobs(repo, sorted(set(get_ref_tips(repo).values())), missing_only=True)
+    if not missing:
+        return
+
+    logging.debug(f"Fetching {len(missing)} missing blob(s) into {repo.git_dir}")
+    with TemporaryFile() as oids_file:
+        oids_file.write("".join(f"{oid}\n" for oid in missing).encode())
+        oids_file.seek(0)
+        # These are the same flags git uses when it lazily fetches a missing object from a promisor remote
+        repo.git.fetch(
+            "origin",
+            "--no-tags",
+            "--no-write-fetch-head",
+            "--recurse-submodules=no",
+            "--filter=blob:none",
+            "--stdin",
+            istream=oids_file,
+            env=env,
+        )
+
+
+def iter_blob_contents(repo, oids):
+    """
+    Yields (object name, contents) for each blob, read through a single `git cat-file --batch` process.
+    """
+    proc = repo.git.cat_file("--batch", as_process=True, istream=subprocess.PIPE)
+
+    # Object names are fed from a separate thread so that neither side of the pipe blocks the other
+    def feed():
+        # When cat-file exits early, the error is raised by the reader below
+        with contextlib.suppress(BrokenPipeError):
+            try:
+                for oid in oids:
+                    proc.stdin.write(f"{oid}\n".encode())
+            finally:
+                proc.stdin.close()
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    for oid in oids:
+        # The header is "<oid> <type> <size>", or "<oid> missing"
+        header = proc.stdout.readline().split()
+        if not header:
+            proc.wait()
+            raise ValueError(f"git cat-file exited with code {proc.returncode} before reading blob {oid} from {repo.git_dir}")
+        # Skipping the blob would cache the ref tips without its URIs, so it would never be scanned
+        if header[1] == b"missing":
+            proc.kill()
+            raise ValueError(f"Blob {oid} is missing from {repo.git_dir}")
+        contents = proc.stdout.read(int(header[2]))
+        proc.stdout.read(1)  # trailing newline
+        yield oid, contents
+
+    feeder.join()
+    proc.wait()
+
+
+def extract_raw_watcloud_uris(contents):
+    # Like `git grep`, skip binary blobs, i.e. those with a NUL byte in the first 8000 bytes
+    if b"\0" in contents[:8000]:
+        return set()
+    return set(
+        m.group().decode("utf-8", "replace").strip()
+        for m in WATCLOUD_URI_PATTERN.finditer(contents)
+    )
+
 
-        yield repo
+def scan_blobs(git_dir, oids):
+    """
+    Returns the raw WATcloud URIs found in each blob. Runs in scanner processes, so the repo is opened by path.
+    """
+    repo = Repo(git_dir)
+    return {oid: extract_raw_watcloud_uris(contents) for oid, contents in iter_blob_contents(repo, oids)}
+
+
+def scan_blobs_sharded(git_dir, oids):
+    """
+    Scans the blobs in shards across a pool of processes, each with its own `git cat-file --batch`, and merges the results.
+    Few enough blobs for a single shard are scanned in this process.
+    """
+    shards = [oids[i : i + SCAN_SHARD_SIZE] for i in range(0, len(oids), SCAN_SHARD_SIZE)]
+    if len(shards) <= 1 or SCAN_PROCESSES <= 1:
+        return scan_blobs(git_dir, oids)
+
+    blobs = {}
+    # Repos are synced on other threads while this one scans, and forking a multi-threaded process is unsafe
+    context = multiprocessing.get_context("forkserver")
+    with ProcessPoolExecutor(max_workers=min(SCAN_PROCESSES, len(shards)), mp_context=context) as executor:
+        for shard_blobs in executor.map(scan_blobs, itertools.repeat(git_dir), shards):
+            blobs.update(shard_blobs)
+    return blobs
 
 
 @app.command()
-def get_raw_watcloud_uris(repo_path: Path):
+def get_raw_watcloud_uris(repo_path: Path, cache_dir: Optional[Path] = None):
     repo = Repo(repo_path)
 
-    # -h suppresses filename output
-    # --only-matching returns only the matched text
-    try:
-        out = repo.git.execute(
-            ["git", "grep", "--only-matching", "-h", "watcloud://[^\"' ]*"]
-            + [r.name for r in repo.refs]
-        )
-    except GitCommandError as e:
-        # when `git grep` doesn't find any matches, it throws a GitCommandError with status 1
-        if e.status == 1:
-            logging.debug(f"{repo.working_dir} does not contain any WATcloud URIs")
-            out = ""
-        else:
-            raise
+    # Scan results are cached per blob, so only blobs that were not reachable from any ref
+    # in the last scan are read. Unchanged refs skip the scan entirely.
+    cache_path = None
+    if cache_dir is not None:
+        repo_id = sha256(str(Path(repo.git_dir).resolve()).encode()).hexdigest()
+        cache_path = Path(cache_dir) / f"{repo_id}.json"
+    cache = ScanCache(cache_path)
 
-    uris = set(u.strip() for u in out.splitlines() if u.strip())
+    tips = get_ref_tips(repo)
+    if tips == cache.tips:
+        logging.debug(f"No refs have moved in {repo.working_dir} since the last scan")
+        return cache.uris()
 
-    return uris
+    oids = list_blobs(repo, sorted(set(tips.values())))
+    uncached = [oid for oid in oids if oid not in cache.blobs]
+    logging.debug(f"Scanning {len(uncached)}/{len(oids)} blob(s) in {repo.working_dir}")
+
+    blobs = {oid: cache.blobs[oid] for oid in oids if oid in cache.blobs}
+    blobs.update(scan_blobs_sharded(repo.git_dir, uncached))
+
+    cache.update(tips, blobs)
+    cache.save()
+
+    return cache.uris()
 
 
 @app.command()
-def get_watcloud_uris(repo_path: Path):
-    raw_uris = get_raw_watcloud_uris(repo_path)
-
-    for uri in raw_uris:
-        try:
-            yield WATcloudURI(uri)
-        except ValueError as e:
-            logging.debug(f"Skipping invalid WATcloud URI '{uri}': {e}")
+def get_watcloud_uris(repo_path: Path, cache_dir: Optional[Path] = None):
+    raw_uris = get_raw_watcloud_uris(repo_path, cache_dir)
+
+    def on_invalid(uri, e):
+        logging.debug(f"Skipping invalid WATcloud URI '{uri}': {e}")
+
+    yield from parse_many(raw_uris, on_invalid)
 
 
 if __name__ == "__main__":
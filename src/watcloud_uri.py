@@ -1,5 +1,11 @@
+import logging
 import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
 from urllib.parse import urlparse, parse_qs
 
 RESOLVER_URL_PREFIXES = [
@@ -8,16 +14,40 @@ RESOLVER_URL_PREFIXES = [
     "https://rgw.watonomous.ca/asset-off-perm",
 ]
 
+# Seconds to wait for each HEAD request
+RESOLVE_TIMEOUT = 10
+RESOLVE_CONCURRENCY = 16
+# Number of digests whose resolution is remembered
+RESOLVE_CACHE_SIZE = 100000
+# Seconds for which a digest is remembered to be found under a prefix. Objects move between buckets over time.
+RESOLVE_CACHE_TTL = 60 * 60
+# Seconds for which a digest is remembered to be missing from a prefix. New uploads should show up quickly.
+RESOLVE_NEGATIVE_CACHE_TTL = 60
+
+
+SHA256_PATTERN = re.compile(r"sha256:([a-f0-9]{64})")
+
+# URIs in canonical form, which is what almost every URI is. These parse the same way as the general path below.
+# Names with characters that the general path would decode (e.g. "%20" or "+") are left to the general path.
+CANONICAL_URI_PATTERN = re.compile(r"watcloud://v1/sha256:([a-f0-9]{64})(?:\?name=([A-Za-z0-9._~-]+))?")
+
 
 def extract_sha256(s):
-    sha256_match = re.search(r"sha256:([a-f0-9]{64})", s)
+    sha256_match = SHA256_PATTERN.search(s)
     if not sha256_match:
         raise ValueError("Invalid string: does not contain a SHA-256 hash.")
     return sha256_match.group(1)
 
 
 class WATcloudURI:
+    __slots__ = ("sha256", "name")
+
     def __init__(self, input_url):
+        canonical_match = CANONICAL_URI_PATTERN.fullmatch(input_url)
+        if canonical_match:
+            self.sha256, self.name = canonical_match.groups()
+            return
+
         parsed_url = urlparse(input_url)
         if parsed_url.scheme != "watcloud":
             raise ValueError("Invalid WATcloud URI: protocol must be 'watcloud:'")
@@ -31,12 +61,7 @@ class WATcloudURI:
         self.name = query_params.get("name", [None])[0]
 
     def resolve_to_url(self):
-        for prefix in RESOLVER_URL_PREFIXES:
-            url = f"{prefix}/{self.sha256}"
-            response = requests.head(url)
-            if response.ok:
-                return url
-        raise ValueError("Asset not found.")
+        return get_default_resolver().resolve(self)
 
     def __str__(self):
         return f"watcloud://v1/sha256:{self.sha256}?name={self.name}"
@@ -47,6 +72,131 @@ class WATcloudURI:
     def __lt__(self, other):
         return self.sha256 < other.sha256
 
+def parse_many(raw_uris, on_invalid=None):
+    """
+    Parse many raw WATcloud URIs. Invalid URIs are skipped, after being passed to `on_invalid` with the error.
+    """
+    uris = []
+    canonical_match = CANONICAL_URI_PATTERN.fullmatch
+    for raw_uri in raw_uris:
+        match = canonical_match(raw_uri)
+        if match:
+            # Skips __init__, which would match the URI again
+            uri = WATcloudURI.__new__(WATcloudURI)
+            uri.sha256, uri.name = match.groups()
+            uris.append(uri)
+            continue
+        try:
+            uris.append(WATcloudURI(raw_uri))
+        except ValueError as e:
+            if on_invalid is not None:
+                on_invalid(raw_uri, e)
+    return uris
+
+
+class Resolver:
+    """
+    Resolves WATcloud URIs to URLs by probing each prefix with HEAD requests over a pooled session.
+    The prefix a digest was found under is cached, and so are the prefixes it was missing from,
+    so that known misses are not probed again until they expire.
+    Safe to use from multiple threads.
+    """
+
+    def __init__(
+        self,
+        prefixes=RESOLVER_URL_PREFIXES,
+        concurrency=RESOLVE_CONCURRENCY,
+        timeout=RESOLVE_TIMEOUT,
+        cache_size=RESOLVE_CACHE_SIZE,
+        ttl=RESOLVE_CACHE_TTL,
+        negative_ttl=RESOLVE_NEGATIVE_CACHE_TTL,
+        session=None,
+    ):
+        self.prefixes = list(prefixes)
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=len(self.prefixes), pool_maxsize=concurrency)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.session = session
+
+        self._lock = threading.Lock()
+        # sha256 -> (prefix it was found under and when that expires, {prefix it was missing from: when that expires})
+        self._cache = OrderedDict()
+
+    def _lookup(self, sha256):
+        now = time.monotonic()
+        with self._lock:
+            if sha256 not in self._cache:
+                return None, {}
+            self._cache.move_to_end(sha256)
+            (found, found_expires_at), missed = self._cache[sha256]
+            if found is not None and found_expires_at <= now:
+                found = None
+            return found, {prefix: expires_at for prefix, expires_at in missed.items() if expires_at > now}
+
+    def _remember(self, sha256, found, missed):
+        with self._lock:
+            self._cache[sha256] = ((found, time.monotonic() + self.ttl), missed)
+            self._cache.move_to_end(sha256)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def resolve(self, uri):
+        found, missed = self._lookup(uri.sha256)
+        if found is not None:
+            return f"{found}/{uri.sha256}"
+
+        for prefix in self.prefixes:
+            if prefix in missed:
+                continue
+            url = f"{prefix}/{uri.sha256}"
+            if self.session.head(url, timeout=self.timeout).ok:
+                self._remember(uri.sha256, prefix, missed)
+                return url
+            missed[prefix] = time.monotonic() + self.negative_ttl
+
+        self._remember(uri.sha256, None, missed)
+        raise ValueError("Asset not found.")
+
+    def resolve_many(self, uris):
+        """
+        Resolve many URIs concurrently. Returns the URL of each URI in order, or None if the asset was not found.
+        A URI whose requests fail is also None, without affecting the rest of the batch. Failed requests are not
+        cached as misses, so the URI is probed again next time.
+        """
+
+        def resolve_or_none(uri):
+            try:
+                return self.resolve(uri)
+            except ValueError:
+                return None
+            except requests.RequestException as e:
+                logging.warning(f"Failed to resolve {uri.sha256}: {e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return list(executor.map(resolve_or_none, uris))
+
+
+_default_resolver = None
+_default_resolver_lock = threading.Lock()
+
+
+def get_default_resolver():
+    global _default_resolver
+    with _default_resolver_lock:
+        if _default_resolver is None:
+            _default_resolver = Resolver()
+        return _default_resolver
+
+
 if __name__ == "__main__":
     # Example usage
     uri = WATcloudURI("watcloud://v1/sha256:906f98c1d660a70a6b36ad14c559a9468fe7712312beba1d24650cc379a62360?name=cloud-light.avif")
@@ -1,13 +1,18 @@
+import json
+import threading
 from hashlib import sha256
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
 import boto3
-from git import Repo
+import pytest
+from git import Git, Repo
 from moto import mock_aws
 from watcloud_utils.logging import logger, set_up_logging
 
 from src.agent import Agent
+from src.utils import SYNC_COMPLETE_MARKER
+from src.transfer import HashPipeline
 
 set_up_logging()
 
@@ -422,3 +427,427 @@ def test_multiple_files_multiple_branches():
         assert len(list(off_perm_bucket.objects.all())) == 2
         assert off_perm_bucket.Object(test_content_sha256_2).get()["Body"].read() == test_content2
         assert off_perm_bucket.Object(test_content_sha256_3).get()["Body"].read() == test_content3
+
+@mock_aws
+def test_buckets_on_different_endpoints():
+    """
+    This test simulates buckets that are hosted on different endpoints, where server-side copies are not possible.
+
+    The agent should stream objects between the buckets instead.
+    """
+    with TemporaryDirectory() as workspace_dir, TemporaryDirectory() as repo_dir:
+        bucket_config = set_up_buckets()
+        # moto serves every S3 endpoint, so this only makes the endpoints compare differently
+        bucket_config["perm"]["endpoint_url"] = "https://s3.amazonaws.com"
+        repo = set_up_repo(repo_dir)
+        repo_config = {"repos": [{"type": "local", "path": repo_dir}]}
+        agent = Agent(bucket_config, repo_config, workspace_dir)
+        temp_bucket = boto3.resource("s3").Bucket(bucket_config["temp"]["bucket_name"])
+        perm_bucket = boto3.resource("s3").Bucket(bucket_config["perm"]["bucket_name"])
+        off_perm_bucket = boto3.resource("s3").Bucket(bucket_config["off-perm"]["bucket_name"])
+
+        test_content = b"some test content"
+        test_content_sha256 = sha256(test_content).hexdigest()
+        temp_bucket.put_object(Key=test_content_sha256, Body=test_content)
+        commit_to_repo(repo, "file.txt", f"watcloud://v1/sha256:{test_content_sha256}")
+
+        # temp -> perm crosses endpoints
+        agent.run()
+
+        assert len(list(temp_bucket.objects.all())) == 0
+        assert perm_bucket.Object(test_content_sha256).get()["Body"].read() == test_content
+
+        # perm -> off-perm crosses endpoints
+        commit_to_repo(repo, "file.txt", "watcloud://v1/sha256:dummy-sha256")
+        agent.run()
+
+        assert len(list(perm_bucket.objects.all())) == 0
+        assert off_perm_bucket.Object(test_content_sha256).get()["Body"].read() == test_content
+
+        # off-perm -> perm crosses endpoints
+        commit_to_repo(repo, "file.txt", f"watcloud://v1/sha256:{test_content_sha256}")
+        agent.run()
+
+        assert len(list(off_perm_bucket.objects.all())) == 0
+        assert perm_bucket.Object(test_content_sha256).get()["Body"].read() == test_content
+
+
+@mock_aws
+def test_checksum_mismatch():
+    """
+    This test simulates an object in the temp bucket whose content does not match its key.
+
+    The agent should report the mismatch after still promoting the other objects.
+    """
+    with TemporaryDirectory() as workspace_dir, TemporaryDirectory() as repo_dir:
+        bucket_config = set_up_buckets()
+        repo = set_up_repo(repo_dir)
+        temp_bucket = boto3.resource("s3").Bucket(bucket_config["temp"]["bucket_name"])
+        perm_bucket = boto3.resource("s3").Bucket(bucket_config["perm"]["bucket_name"])
+
+        test_content = b"some test content"
+        test_content_sha256 = sha256(test_content).hexdigest()
+        temp_bucket.put_object(Key=test_content_sha256, Body=test_content)
+        bad_content_sha256 = sha256(b"expected content").hexdigest()
+        temp_bucket.put_object(Key=bad_content_sha256, Body=b"tampered content")
+
+        commit_to_repo(repo, "file1_uri.txt", f"watcloud://v1/sha256:{test_content_sha256}")
+        commit_to_repo(repo, "file2_uri.txt", f"watcloud://v1/sha256:{bad_content_sha256}")
+
+        agent = Agent(bucket_config, {"repos": [{"type": "local", "path": repo_dir}]}, workspace_dir)
+
+        with pytest.raises(ValueError, match="1 errors"):
+            agent.run()
+
+        assert [obj.key for obj in temp_bucket.objects.all()] == [bad_content_sha256]
+        assert [obj.key for obj in perm_bucket.objects.all()] == [test_content_sha256]
+
+
+@mock_aws
+def test_multiple_repos():
+    """
+    This test simulates WATcloud URIs spread across multiple repos, which are synced in parallel.
+
+    The agent should move the files referenced from any repo to the perm bucket.
+    """
+    with TemporaryDirectory() as workspace_dir, TemporaryDirectory() as repo_dir1, TemporaryDirectory() as repo_dir2:
+        bucket_config = set_up_buckets()
+        repo1 = set_up_repo(repo_dir1)
+        repo2 = set_up_repo(repo_dir2)
+        temp_bucket = boto3.resource("s3").Bucket(bucket_config["temp"]["bucket_name"])
+        perm_bucket = boto3.resource("s3").Bucket(bucket_config["perm"]["bucket_name"])
+
+        test_content1 = b"some test content 1"
+        test_content_sha256_1 = sha256(test_content1).hexdigest()
+        temp_bucket.put_object(Key=test_content_sha256_1, Body=test_content1)
+        commit_to_repo(repo1, "file.txt", f"watcloud://v1/sha256:{test_content_sha256_1}")
+
+        test_content2 = b"some test content 2"
+        test_content_sha256_2 = sha256(test_content2).hexdigest()
+        temp_bucket.put_object(Key=test_content_sha256_2, Body=test_content2)
+        commit_to_repo(repo2, "file.txt", f"watcloud://v1/sha256:{test_content_sha256_2}")
+
+        repo_config = {"repos": [{"type": "local", "path": repo_dir1}, {"type": "local", "path": repo_dir2}]}
+        agent = Agent(bucket_config, repo_config, workspace_dir, repo_sync_concurrency=2)
+
+        agent.run()
+
+        assert len(list(temp_bucket.objects.all())) == 0
+        assert perm_bucket.Object(test_content_sha256_1).get()["Body"].read() == test_content1
+        assert perm_bucket.Object(test_content_sha256_2).get()["Body"].read() == test_content2
+
+
+@mock_aws
+def test_remote_repo(monkeypatch):
+    """
+    This test simulates a remote repo, which the agent syncs into a bare partial-clone mirror.
+
+    The agent should pick up WATcloud URIs from branches created after the initial clone.
+    Once a run has nothing to do, later runs should neither fetch nor reconcile until something changes,
+    unless the last sync did not complete.
+    """
+    with TemporaryDirectory() as workspace_dir, TemporaryDirectory() as repo_dir:
+        bucket_config = set_up_buckets()
+        repo = set_up_repo(repo_dir)
+        # allow the mirror to fetch blobs on demand, like GitHub does
+        repo.git.config("uploadpack.allowFilter", "true")
+        repo.git.config("uploadpack.allowAnySHA1InWant", "true")
+        repo_config = {"repos": [{"type": "git+https", "url": f"file://{repo_dir}"}]}
+        agent = Agent(bucket_config, repo_config, workspace_dir)
+        temp_bucket = boto3.resource("s3").Bucket(bucket_config["temp"]["bucket_name"])
+        perm_bucket = boto3.resource("s3").Bucket(bucket_config["perm"]["bucket_name"])
+
+        agent.run()
+
+        test_content = b"some test content"
+        test_content_sha256 = sha256(test_content).hexdigest()
+        temp_bucket.put_object(Key=test_content_sha256, Body=test_content)
+        commit_to_repo(repo, "file.txt", f"watcloud://v1/sha256:{test_content_sha256}", branch="new-branch")
+
+        agent.run()
+
+        assert len(list(temp_bucket.objects.all())) == 0
+        assert perm_bucket.Object(test_content_sha256).get()["Body"].read() == test_content
+
+        # This run has nothing to do, so it records the state it found
+        agent.run()
+        assert json.loads(agent.state_path.read_text())["idle_fingerprint"] is not None
+
+        # Nothing changed, so the agent skips fetching and reconciling
+        def fail(*args, **kwargs):
+            raise AssertionError("Nothing changed, so this should be skipped")
+
+        with monkeypatch.context() as m:
+            m.setattr("src.agent.reconcile", fail)
+            m.setattr("src.utils.fetch_missing_blobs", fail)
+            m.setattr(Git, "fetch", fail, raising=False)
+            agent.run()
+
+        # A sync that was interrupted before it fetched the blobs is completed by the next one
+        marker = Path(workspace_dir) / "mirrors" / f"file://{repo_dir}" / SYNC_COMPLETE_MARKER
+        marker.unlink()
+        fetched = []
+        with monkeypatch.context() as m:
+            m.setattr("src.utils.fetch_missing_blobs", lambda repo, env=None: fetched.append(repo))
+            agent.run()
+        assert len(fetched) == 1
+        assert marker.exists()
+
+        assert len(list(temp_bucket.objects.all())) == 0
+        assert perm_bucket.Object(test_content_sha256).get()["Body"].read() == test_content
+
+
+@mock_aws
+def test_inventory_refresh():
+    """
+    This test simulates an object that appears in the perm bucket without going through the agent.
+
+    The agent trusts its inventory of the perm bucket until the inventory expires, and then retires the object.
+    """
+    with TemporaryDirectory() as workspace_dir, TemporaryDirectory() as repo_dir:
+        bucket_config = set_up_buckets()
+        set_up_repo(repo_dir)
+        repo_config = {"repos": [{"type": "local", "path": repo_dir}]}
+        perm_bucket = boto3.resource("s3").Bucket(bucket_config["perm"]["bucket_name"])
+        off_perm_bucket = boto3.resource("s3").Bucket(bucket_config["off-perm"]["bucket_name"])
+
+        Agent(bucket_config, repo_config, workspace_dir).run()
+
+        test_content = b"some test content"
+        test_content_sha256 = sha256(test_content).hexdigest()
+        perm_bucket.put_object(Key=test_content_sha256, Body=test_content)
+
+        Agent(bucket_config, repo_config, workspace_dir).run()
+
+        assert len(list(perm_bucket.objects.all())) == 1
+        assert len(list(off_perm_bucket.objects.all())) == 0
+
+        Agent(bucket_config, repo_config, workspace_dir, inventory_max_age=0).run()
+
+        assert len(list(perm_bucket.objects.all())) == 0
+        assert off_perm_bucket.Object(test_content_sha256).get()["Body"].read() == test_content
+
+
+@mock_aws
+def test_resume_interrupted_plan():
+    """
+    This test simulates a plan that was interrupted after one of its copies completed.
+
+    Applying the plan again should only delete the source of the completed copy and carry out the rest.
+    """
+    with TemporaryDirectory() as workspace_dir, TemporaryDirectory() as repo_dir:
+        bucket_config = set_up_buckets()
+        repo = set_up_repo(repo_dir)
+        temp_bucket = boto3.resource("s3").Bucket(bucket_config["temp"]["bucket_name"])
+        perm_bucket = boto3.resource("s3").Bucket(bucket_config["perm"]["bucket_name"])
+
+        test_contents = [b"some test content", b"some other test content"]
+        test_content_sha256s = [sha256(content).hexdigest() for content in test_contents]
+        for content, content_sha256 in zip(test_contents, test_content_sha256s):
+            temp_bucket.put_object(Key=content_sha256, Body=content)
+        commit_to_repo(
+            repo, "file.txt", "\n".join(f"watcloud://v1/sha256:{s}" for s in test_content_sha256s)
+        )
+
+        repo_config = {"repos": [{"type": "local", "path": repo_dir}]}
+        agent = Agent(bucket_config, repo_config, workspace_dir)
+
+        plan = agent.plan()
+        assert sorted(plan["temp_to_perm"]) == sorted(test_content_sha256s)
+
+        # The first copy completed before the interruption
+        done_sha256 = test_content_sha256s[0]
+        perm_bucket.put_object(Key=done_sha256, Body=test_contents[0], Metadata={"copied": "before-interruption"})
+        agent.inventory.put("perm", done_sha256, len(test_contents[0]))
+        Path(workspace_dir, "plan.json.checkpoint").write_text(f"copied temp_to_perm {done_sha256}\n")
+
+        agent.run()
+
+        assert len(list(temp_bucket.objects.all())) == 0
+        assert len(list(perm_bucket.objects.all())) == 2
+        assert perm_bucket.Object(done_sha256).metadata == {"copied": "before-interruption"}
+        assert not Path(workspace_dir, "plan.json").exists()
+        assert not Path(workspace_dir, "plan.json.checkpoint").exists()
+
+
+@mock_aws
+def test_plan_for_review():
+    """
+    This test plans for review when there is nothing to do, then when there is something to do, and runs the agent in between.
+
+    Applying when nothing was planned should do nothing, and a plan written for review should not be picked up
+    by a run as an interrupted plan.
+    """
+    with TemporaryDirectory() as workspace_dir, TemporaryDirectory() as repo_dir:
+        bucket_config = set_up_buckets()
+        repo = set_up_repo(repo_dir)
+        repo_config = {"repos": [{"type": "local", "path": repo_dir}]}
+        agent = Agent(bucket_config, repo_config, workspace_dir)
+
+        assert agent.plan(agent.review_plan_path) is None
+        agent.apply(agent.review_plan_path)
+
+        temp_bucket = boto3.resource("s3").Bucket(bucket_config["temp"]["bucket_name"])
+        test_content = b"some test content"
+        test_content_sha256 = sha256(test_content).hexdigest()
+        temp_bucket.put_object(Key=test_content_sha256, Body=test_content)
+        commit_to_repo(repo, "file.txt", f"watcloud://v1/sha256:{test_content_sha256}")
+
+        assert agent.plan(agent.review_plan_path)["temp_to_perm"] == [test_content_sha256]
+        assert not agent.plan_path.exists()
+
+        agent.run()
+        assert agent.review_plan_path.exists()
+
+
+@mock_aws
+@pytest.mark.parametrize("trust_native_checksums", [None, False, True])
+def test_native_checksum(monkeypatch, trust_native_checksums):
+    """
+    This test simulates an upload to the temp bucket that was sent with a SHA-256 checksum.
+
+    When the temp bucket is configured to trust its checksums, the agent should verify the object with the checksum
+    recorded by the bucket instead of downloading and hashing it. Otherwise, which is the default, the agent should
+    hash the object as usual.
+    """
+    hashed = []
+    hash_stream = HashPipeline.hash_stream
+
+    def record_hash_stream(self, *args, **kwargs):
+        hashed.append(True)
+        return hash_stream(self, *args, **kwargs)
+
+    monkeypatch.setattr(HashPipeline, "hash_stream", record_hash_stream)
+
+    with TemporaryDirectory() as workspace_dir, TemporaryDirectory() as repo_dir:
+        bucket_config = set_up_buckets()
+        if trust_native_checksums is not None:
+            bucket_config["temp"]["trust_native_checksums"] = trust_native_checksums
+        repo = set_up_repo(repo_dir)
+
+        temp_bucket = boto3.resource("s3").Bucket(bucket_config["temp"]["bucket_name"])
+        test_content = b"some test content"
+        test_content_sha256 = sha256(test_content).hexdigest()
+        temp_bucket.put_object(Key=test_content_sha256, Body=test_content, ChecksumAlgorithm="SHA256")
+
+        commit_to_repo(repo, "file.txt", f"watcloud://v1/sha256:{test_content_sha256}")
+
+        repo_config = {"repos": [{"type": "local", "path": repo_dir}]}
+        Agent(bucket_config, repo_config, workspace_dir).run()
+
+        perm_bucket = boto3.resource("s3").Bucket(bucket_config["perm"]["bucket_name"])
+        assert len(hashed) == (0 if trust_native_checksums else 1)
+        assert len(list(temp_bucket.objects.all())) == 0
+        assert perm_bucket.Object(test_content_sha256).get()["Body"].read() == test_content
+
+
+@mock_aws
+def test_large_objects():
+    """
+    This test puts the perm bucket on another endpoint and configures it to upload every object in parts,
+    so every promotion goes through the large object lane.
+
+    The agent should move the files from the temp bucket to the perm bucket as usual.
+    """
+    with TemporaryDirectory() as workspace_dir, TemporaryDirectory() as repo_dir:
+        bucket_config = set_up_buckets()
+        bucket_config["perm"]["endpoint_url"] = "https://s3.amazonaws.com"
+        bucket_config["perm"]["transfer"] = {"multipart_threshold": 1}
+        repo = set_up_repo(repo_dir)
+        temp_bucket = boto3.resource("s3").Bucket(bucket_config["temp"]["bucket_name"])
+        perm_bucket = boto3.resource("s3").Bucket(bucket_config["perm"]["bucket_name"])
+
+        test_contents = [b"some test content", b"some larger test content"]
+        test_content_sha256s = [sha256(content).hexdigest() for content in test_contents]
+        for content, content_sha256 in zip(test_contents, test_content_sha256s):
+            temp_bucket.put_object(Key=content_sha256, Body=content)
+        commit_to_repo(
+            repo, "file.txt", "\n".join(f"watcloud://v1/sha256:{s}" for s in test_content_sha256s)
+        )
+
+        repo_config = {"repos": [{"type": "local", "path": repo_dir}]}
+        agent = Agent(bucket_config, repo_config, workspace_dir)
+        assert agent.is_large_move("temp_to_perm", len(test_contents[0]))
+        agent.run()
+
+        assert len(list(temp_bucket.objects.all())) == 0
+        for content, content_sha256 in zip(test_contents, test_content_sha256s):
+            assert perm_bucket.Object(content_sha256).get()["Body"].read() == content
+
+
+@mock_aws
+def test_ingest_duplicate_keys():
+    """
+    This test commits a WATcloud URI before the object is uploaded, then ingests the same upload twice in one batch,
+    as happens when a bucket notification is delivered more than once.
+
+    The agent should promote the object once.
+    """
+    with TemporaryDirectory() as workspace_dir, TemporaryDirectory() as repo_dir:
+        bucket_config = set_up_buckets()
+        repo = set_up_repo(repo_dir)
+
+        test_content = b"some test content"
+        test_content_sha256 = sha256(test_content).hexdigest()
+        commit_to_repo(repo, "file.txt", f"watcloud://v1/sha256:{test_content_sha256}")
+
+        repo_config = {"repos": [{"type": "local", "path": repo_dir}]}
+        agent = Agent(bucket_config, repo_config, workspace_dir)
+        # The object has not been uploaded yet
+        with pytest.raises(ValueError):
+            agent.run()
+
+        temp_bucket = boto3.resource("s3").Bucket(bucket_config["temp"]["bucket_name"])
+        temp_bucket.put_object(Key=test_content_sha256, Body=test_content)
+
+        heads = []
+        agent.buckets["temp"].client.meta.events.register(
+            "before-parameter-build.s3.HeadObject", lambda params, **kwargs: heads.append(params["Key"])
+        )
+        agent.ingest([test_content_sha256, test_content_sha256])
+
+        assert heads == [test_content_sha256]
+        perm_bucket = boto3.resource("s3").Bucket(bucket_config["perm"]["bucket_name"])
+        assert len(list(temp_bucket.objects.all())) == 0
+        assert perm_bucket.Object(test_content_sha256).get()["Body"].read() == test_content
+
+
+@mock_aws
+def test_large_unverified_promotion(monkeypatch):
+    """
+    This test promotes an object within the same endpoint from a temp bucket whose checksums are not trusted.
+
+    The object is server-side copied, but it has to be downloaded and hashed first, so it should go through
+    the large object lane once it reaches the multipart threshold. Server-side copies that don't need
+    verifying should only count as large above the CopyObject limit, whatever the multipart threshold.
+    """
+    lanes = []
+    apply_move = Agent.apply_move
+
+    def record_lane(self, move, obj_key, *args):
+        lanes.append(threading.current_thread().name.rsplit("_", 1)[0])
+        return apply_move(self, move, obj_key, *args)
+
+    monkeypatch.setattr(Agent, "apply_move", record_lane)
+
+    with TemporaryDirectory() as workspace_dir, TemporaryDirectory() as repo_dir:
+        bucket_config = set_up_buckets()
+        bucket_config["perm"]["transfer"] = {"multipart_threshold": 1}
+        repo = set_up_repo(repo_dir)
+        temp_bucket = boto3.resource("s3").Bucket(bucket_config["temp"]["bucket_name"])
+        perm_bucket = boto3.resource("s3").Bucket(bucket_config["perm"]["bucket_name"])
+
+        test_content = b"some test content"
+        test_content_sha256 = sha256(test_content).hexdigest()
+        temp_bucket.put_object(Key=test_content_sha256, Body=test_content)
+        commit_to_repo(repo, "file.txt", f"watcloud://v1/sha256:{test_content_sha256}")
+
+        bucket_config["off-perm"]["transfer"] = {"multipart_threshold": 1}
+        repo_config = {"repos": [{"type": "local", "path": repo_dir}]}
+        agent = Agent(bucket_config, repo_config, workspace_dir)
+        assert not agent.is_large_move("perm_to_off_perm", 5 * 1024**3)
+        assert agent.is_large_move("perm_to_off_perm", 5 * 1024**3 + 1)
+        agent.run()
+
+        assert lanes == ["large-transfer"]
+        assert perm_bucket.Object(test_content_sha256).get()["Body"].read() == test_content
@@ -0,0 +1,124 @@
+import json
+import threading
+import time
+import urllib.request
+from hashlib import sha256
+from tempfile import TemporaryDirectory
+
+import boto3
+from moto import mock_aws
+from watcloud_utils.logging import set_up_logging
+
+from src.agent import Agent
+from src.daemon import Daemon
+from src.resolver_service import DigestIndex
+from test_agent import commit_to_repo, set_up_buckets, set_up_repo
+
+set_up_logging()
+
+
+def wait_for(condition, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.05)
+
+
+@mock_aws
+def test_triggered_reconciliation():
+    """
+    This test runs the daemon, then uploads an object, commits its WATcloud URI and triggers a reconciliation over HTTP.
+
+    The daemon should promote the object without waiting for the interval to pass.
+    """
+    with TemporaryDirectory() as workspace_dir, TemporaryDirectory() as repo_dir:
+        bucket_config = set_up_buckets()
+        repo = set_up_repo(repo_dir)
+        repo_config = {"repos": [{"type": "local", "path": repo_dir}]}
+
+        daemon = Daemon(Agent(bucket_config, repo_config, workspace_dir), interval=3600, port=0)
+        thread = threading.Thread(target=daemon.serve_forever)
+        thread.start()
+        try:
+            wait_for(lambda: daemon.status["reconciliations"] == 1)
+
+            temp_bucket = boto3.resource("s3").Bucket(bucket_config["temp"]["bucket_name"])
+            test_content = b"some test content"
+            test_content_sha256 = sha256(test_content).hexdigest()
+            temp_bucket.put_object(Key=test_content_sha256, Body=test_content)
+            commit_to_repo(repo, "file.txt", f"watcloud://v1/sha256:{test_content_sha256}")
+
+            port = daemon.server.server_address[1]
+            request = urllib.request.Request(f"http://127.0.0.1:{port}/reconcile", method="POST")
+            with urllib.request.urlopen(request) as response:
+                assert response.status == 202
+
+            wait_for(lambda: daemon.status["reconciliations"] == 2)
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/healthz") as response:
+                assert json.loads(response.read())["last_error"] is None
+        finally:
+            daemon.stop()
+            thread.join()
+
+        perm_bucket = boto3.resource("s3").Bucket(bucket_config["perm"]["bucket_name"])
+        assert perm_bucket.Object(test_content_sha256).get()["Body"].read() == test_content
+
+
+@mock_aws
+def test_upload_notification():
+    """
+    This test commits a WATcloud URI before the object is uploaded, then uploads the object and sends the daemon a bucket notification.
+
+    The daemon should promote the object as soon as it is notified, without a reconciliation, and resolve it
+    from perm right away. A new agent on the same workspace should resolve it before it runs at all.
+    """
+    with TemporaryDirectory() as workspace_dir, TemporaryDirectory() as repo_dir:
+        bucket_config = set_up_buckets()
+        repo = set_up_repo(repo_dir)
+        repo_config = {"repos": [{"type": "local", "path": repo_dir}]}
+
+        test_content = b"some test content"
+        test_content_sha256 = sha256(test_content).hexdigest()
+        commit_to_repo(repo, "file.txt", f"watcloud://v1/sha256:{test_content_sha256}")
+
+        agent = Agent(bucket_config, repo_config, workspace_dir, digest_index=DigestIndex())
+        daemon = Daemon(agent, interval=3600, port=0)
+        thread = threading.Thread(target=daemon.serve_forever)
+        thread.start()
+        try:
+            wait_for(lambda: daemon.status["reconciliations"] == 1)
+            # The object has not been uploaded yet
+            assert daemon.status["last_error"] is not None
+
+            temp_bucket = boto3.resource("s3").Bucket(bucket_config["temp"]["bucket_name"])
+            temp_bucket.put_object(Key=test_content_sha256, Body=test_content)
+
+            notification = {
+                "Records": [
+                    {
+                        "eventName": "ObjectCreated:Put",
+                        "s3": {"bucket": {"name": temp_bucket.name}, "object": {"key": test_content_sha256}},
+                    }
+                ]
+            }
+            port = daemon.server.server_address[1]
+            request = urllib.request.Request(
+                f"http://127.0.0.1:{port}/notifications", data=json.dumps(notification).encode(), method="POST"
+            )
+            with urllib.request.urlopen(request) as response:
+                assert json.loads(response.read()) == {"queued": 1}
+
+            wait_for(lambda: daemon.status["ingestions"] == 1)
+            assert daemon.status["reconciliations"] == 1
+            perm_url = f"{agent.public_url_prefix('perm')}/{test_content_sha256}"
+            assert agent.digest_index.lookup(test_content_sha256) == perm_url
+        finally:
+            daemon.stop()
+            thread.join()
+
+        perm_bucket = boto3.resource("s3").Bucket(bucket_config["perm"]["bucket_name"])
+        assert len(list(temp_bucket.objects.all())) == 0
+        assert perm_bucket.Object(test_content_sha256).get()["Body"].read() == test_content
+        digest_index = DigestIndex()
+        Agent(bucket_config, repo_config, workspace_dir, digest_index=digest_index)
+        assert digest_index.lookup(test_content_sha256) == perm_url
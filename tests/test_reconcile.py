@@ -0,0 +1,40 @@
+import random
+from hashlib import sha256
+
+from src.reconcile import DigestSet, reconcile
+
+
+def test_reconcile_matches_set_operations():
+    """
+    This test compares the streaming merge-join against the set operations it replaces, on random buckets.
+    """
+    rng = random.Random(0)
+    keys = [sha256(str(i).encode()).hexdigest() for i in range(200)] + ["not-a-digest", "README.md"]
+
+    desired = set(rng.sample(keys[:200], 80))
+    temp = set(rng.sample(keys, 60))
+    perm = set(rng.sample(keys, 60))
+    off_perm = set(rng.sample(keys, 60))
+
+    result = reconcile(DigestSet.from_keys(desired), sorted(temp), sorted(perm), sorted(off_perm))
+
+    to_perm = desired - perm
+    temp_to_perm = to_perm & temp - off_perm
+    assert set(result.missing) == desired - (temp | perm | off_perm)
+    assert result.already_in_perm == len(desired & perm)
+    assert set(result.temp_to_perm) == temp_to_perm
+    assert set(result.off_perm_to_perm) == to_perm & off_perm
+    assert set(result.perm_to_off_perm) == perm - desired
+    assert set(result.delete_from_temp) == desired & temp - temp_to_perm
+
+
+def test_digest_set():
+    keys = ["b" * 64, "a" * 64, "not-a-digest", "a" * 64]
+    digests = DigestSet.from_keys(keys)
+
+    assert len(digests) == 3
+    assert list(digests) == sorted(set(keys))
+    assert "a" * 64 in digests
+    assert "not-a-digest" in digests
+    assert "c" * 64 not in digests
+    assert list(DigestSet.from_sorted_keys(iter(sorted(set(keys))))) == list(digests)
@@ -0,0 +1,66 @@
+import json
+import urllib.error
+import urllib.request
+from hashlib import sha256
+from tempfile import TemporaryDirectory
+from urllib.parse import quote
+
+import boto3
+import pytest
+from moto import mock_aws
+from watcloud_utils.logging import set_up_logging
+
+from src.agent import Agent
+from src.resolver_service import DigestIndex, ResolverService
+from test_agent import commit_to_repo, set_up_buckets, set_up_repo
+
+set_up_logging()
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+@mock_aws
+def test_resolver_service():
+    """
+    This test promotes an object with the agent, then resolves WATcloud URIs with the resolver service.
+
+    The promoted object should resolve to the perm bucket, directly or with a redirect, and unknown objects should not resolve.
+    """
+    with TemporaryDirectory() as workspace_dir, TemporaryDirectory() as repo_dir:
+        bucket_config = set_up_buckets()
+        bucket_config["perm"]["public_url_prefix"] = "https://assets.example.com/perm"
+        repo = set_up_repo(repo_dir)
+
+        temp_bucket = boto3.resource("s3").Bucket(bucket_config["temp"]["bucket_name"])
+        test_content = b"some test content"
+        test_content_sha256 = sha256(test_content).hexdigest()
+        temp_bucket.put_object(Key=test_content_sha256, Body=test_content)
+        commit_to_repo(repo, "file.txt", f"watcloud://v1/sha256:{test_content_sha256}")
+
+        digest_index = DigestIndex()
+        repo_config = {"repos": [{"type": "local", "path": repo_dir}]}
+        Agent(bucket_config, repo_config, workspace_dir, digest_index=digest_index).run()
+
+        service = ResolverService(digest_index, port=0)
+        service.start()
+        try:
+            base_url = f"http://127.0.0.1:{service.port}/resolve"
+            uri = quote(f"watcloud://v1/sha256:{test_content_sha256}?name=file.txt")
+            expected_url = f"https://assets.example.com/perm/{test_content_sha256}"
+
+            with urllib.request.urlopen(f"{base_url}?uri={uri}") as response:
+                assert json.loads(response.read()) == {"url": expected_url}
+
+            with pytest.raises(urllib.error.HTTPError) as e:
+                urllib.request.build_opener(NoRedirect).open(f"{base_url}?uri={uri}&redirect")
+            assert e.value.code == 302
+            assert e.value.headers["Location"] == expected_url
+
+            with pytest.raises(urllib.error.HTTPError) as e:
+                urllib.request.urlopen(f"{base_url}?uri={quote('watcloud://v1/sha256:' + '0' * 64)}")
+            assert e.value.code == 404
+        finally:
+            service.stop()
@@ -0,0 +1,76 @@
+import pytest
+from botocore.awsrequest import AWSResponse
+from botocore.exceptions import ClientError
+from moto import mock_aws
+from moto.core.botocore_stubber import MockRawResponse
+
+from src.clients import ClientPool
+from src.retry import AdaptiveLimiter, Retrier, RetryBudget
+
+BUCKET_NAME = "asset-retry-test"
+
+
+def set_up_client(retrier):
+    client = ClientPool(retrier).get(None, "dummy-access-key-id", "dummy-secret-key")
+    client.create_bucket(Bucket=BUCKET_NAME)
+    return client
+
+
+def fail_requests(client, operation, errors):
+    """
+    Makes the store respond to requests for `operation` with the given (status, error code) pairs, in order,
+    before letting requests through. Returns the list of requests sent for the operation.
+    """
+    requests = []
+
+    def respond(request, **kwargs):
+        requests.append(request)
+        if len(requests) > len(errors):
+            return None
+        status, code = errors[len(requests) - 1]
+        body = f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>{code}</Code><Message>{code}</Message></Error>'
+        return AWSResponse(request.url, status, {}, MockRawResponse(body))
+
+    # Registered first, so that it responds instead of the mock store
+    client.meta.events.register_first(f"before-send.s3.{operation}", respond)
+    return requests
+
+
+@mock_aws
+def test_retry_throttled_request():
+    """
+    This test makes a request that is throttled twice before it succeeds.
+
+    The request should be retried by the retrier alone, and the concurrency limit should back off once per
+    throttling error.
+    """
+    limiter = AdaptiveLimiter(8)
+    client = set_up_client(Retrier(limiter, RetryBudget(), max_attempts=5, base_delay=0))
+    requests = fail_requests(client, "PutObject", [(503, "SlowDown"), (503, "SlowDown")])
+
+    client.put_object(Bucket=BUCKET_NAME, Key="object", Body=b"content")
+
+    assert len(requests) == 3
+    assert int(limiter.limit) == 2
+    assert limiter._running == 0
+
+
+@mock_aws
+def test_retry_budget():
+    """
+    This test makes requests that always fail with a retryable error.
+
+    Retries should stop once the shared budget is spent, without botocore retrying on its own, and the error
+    should be raised. Errors that aren't transient should not be retried at all.
+    """
+    client = set_up_client(Retrier(AdaptiveLimiter(8), RetryBudget(reserve=3), max_attempts=5, base_delay=0))
+    requests = fail_requests(client, "PutObject", [(503, "SlowDown")] * 10)
+
+    with pytest.raises(ClientError, match="SlowDown"):
+        client.put_object(Bucket=BUCKET_NAME, Key="object", Body=b"content")
+    assert len(requests) == 4
+
+    requests = fail_requests(client, "GetObject", [(400, "InvalidArgument")])
+    with pytest.raises(ClientError, match="InvalidArgument"):
+        client.get_object(Bucket=BUCKET_NAME, Key="object")
+    assert len(requests) == 1
@@ -0,0 +1,84 @@
+import threading
+from contextlib import ExitStack
+from tempfile import TemporaryDirectory
+
+from watcloud_utils.logging import set_up_logging
+
+from src.spool import SpoolManager
+
+set_up_logging()
+
+
+def spool_in_thread(spools, size, stack):
+    """
+    Spools an object of `size` bytes on another thread, until the returned release event is set.
+    Returns (entered event, release event, thread).
+    """
+    entered = threading.Event()
+    release = threading.Event()
+
+    def run():
+        with spools.spool(size):
+            entered.set()
+            release.wait()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+
+    def stop():
+        release.set()
+        thread.join()
+
+    stack.callback(stop)
+    return entered, release, thread
+
+
+def test_spool_blocks_until_released():
+    """
+    This test spools two objects that don't fit in the disk budget together.
+
+    The second spool should wait until the first one is released. Objects small enough to be kept in memory
+    should not wait.
+    """
+    with TemporaryDirectory() as spool_dir, ExitStack() as stack:
+        spools = SpoolManager(spool_dir, disk_budget=100, memory_limit=10)
+
+        first, release_first, first_thread = spool_in_thread(spools, 60, stack)
+        assert first.wait(5)
+
+        second, _, _ = spool_in_thread(spools, 60, stack)
+        assert not second.wait(0.2)
+
+        with spools.spool(10):
+            pass
+
+        release_first.set()
+        first_thread.join()
+        assert second.wait(5)
+
+
+def test_spool_larger_than_budget():
+    """
+    This test spools an object larger than the whole disk budget.
+
+    It should go through once nothing else is spooled, and other objects should wait for it.
+    """
+    with TemporaryDirectory() as spool_dir, ExitStack() as stack:
+        spools = SpoolManager(spool_dir, disk_budget=100, memory_limit=10)
+
+        first, release_first, first_thread = spool_in_thread(spools, 50, stack)
+        assert first.wait(5)
+
+        huge, release_huge, huge_thread = spool_in_thread(spools, 500, stack)
+        assert not huge.wait(0.2)
+
+        release_first.set()
+        first_thread.join()
+        assert huge.wait(5)
+
+        other, _, _ = spool_in_thread(spools, 50, stack)
+        assert not other.wait(0.2)
+
+        release_huge.set()
+        huge_thread.join()
+        assert other.wait(5)
@@ -0,0 +1,93 @@
+import io
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from moto import mock_aws
+from watcloud_utils.logging import set_up_logging
+
+from src.clients import Bucket
+from src.transfer import DeleteBatcher, upload_stream
+
+set_up_logging()
+
+PART_SIZE = 5 * 1024**2
+
+
+@mock_aws
+def test_resume_multipart_upload():
+    """
+    This test simulates a multipart upload that was interrupted after its first part was uploaded.
+
+    Uploading the object again with the recorded upload ID should only upload the remaining parts and complete
+    the interrupted upload. Without it, the upload may be someone else's in progress, so it should be left alone.
+    """
+    client = boto3.client("s3")
+    bucket = Bucket(client, "asset-upload-test")
+    client.create_bucket(Bucket=bucket.name)
+
+    content = b"a" * PART_SIZE + b"b" * PART_SIZE + b"c"
+    upload_id = client.create_multipart_upload(Bucket=bucket.name, Key="object")["UploadId"]
+    client.upload_part(Bucket=bucket.name, Key="object", UploadId=upload_id, PartNumber=1, Body=content[:PART_SIZE])
+
+    uploaded_parts = []
+    client.meta.events.register(
+        "before-parameter-build.s3.UploadPart", lambda params, **kwargs: uploaded_parts.append(params["PartNumber"])
+    )
+
+    config = TransferConfig(multipart_threshold=PART_SIZE, multipart_chunksize=PART_SIZE)
+    created_upload_ids = []
+    upload_stream(bucket, "object", io.BytesIO(content), len(content), config, upload_id, created_upload_ids.append)
+
+    assert sorted(uploaded_parts) == [2, 3]
+    assert created_upload_ids == []
+    assert client.get_object(Bucket=bucket.name, Key="object")["Body"].read() == content
+    assert client.list_multipart_uploads(Bucket=bucket.name).get("Uploads", []) == []
+
+    other_upload_id = client.create_multipart_upload(Bucket=bucket.name, Key="object")["UploadId"]
+    uploaded_parts.clear()
+    upload_stream(bucket, "object", io.BytesIO(content), len(content), config, None, created_upload_ids.append)
+
+    assert sorted(uploaded_parts) == [1, 2, 3]
+    assert len(created_upload_ids) == 1 and created_upload_ids[0] != other_upload_id
+    uploads = client.list_multipart_uploads(Bucket=bucket.name).get("Uploads", [])
+    assert [upload["UploadId"] for upload in uploads] == [other_upload_id]
+
+
+@mock_aws
+def test_delete_batches():
+    """
+    This test deletes more keys than fit in a batch, with the store reporting that one of the keys failed to delete.
+
+    The keys should be deleted with one request per batch, and the failed key should be reported as an error
+    instead of being passed to `on_delete`.
+    """
+    client = boto3.client("s3")
+    bucket = Bucket(client, "asset-delete-test")
+    client.create_bucket(Bucket=bucket.name)
+    keys = [f"object{i}" for i in range(5)]
+    for key in keys:
+        client.put_object(Bucket=bucket.name, Key=key, Body=b"")
+
+    requests = []
+    client.meta.events.register(
+        "before-parameter-build.s3.DeleteObjects",
+        lambda params, **kwargs: requests.append([obj["Key"] for obj in params["Delete"]["Objects"]]),
+    )
+
+    def fail_object3(parsed, **kwargs):
+        if "object3" in requests[-1]:
+            parsed.setdefault("Errors", []).append({"Key": "object3", "Code": "AccessDenied", "Message": "Access Denied"})
+
+    client.meta.events.register("after-call.s3.DeleteObjects", fail_object3)
+
+    errors = []
+    deleted = []
+    batcher = DeleteBatcher(bucket, errors, on_delete=deleted.extend, batch_size=2)
+    for key in keys:
+        batcher.add(key)
+    batcher.flush()
+
+    assert requests == [keys[0:2], keys[2:4], keys[4:]]
+    assert len(errors) == 1
+    assert "object3" in str(errors[0])
+    assert sorted(deleted) == [key for key in keys if key != "object3"]
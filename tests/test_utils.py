@@ -0,0 +1,98 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import pytest
+from watcloud_utils.logging import set_up_logging
+
+from src.utils import get_raw_watcloud_uris, iter_blob_contents
+from test_agent import commit_to_repo, set_up_repo
+
+set_up_logging()
+
+
+def test_incremental_scan():
+    """
+    This test scans a repo with a scan cache, then moves, adds and deletes refs between scans.
+
+    Each scan should reflect the current ref tips, whether they were scanned before or not.
+    """
+    with TemporaryDirectory() as cache_dir, TemporaryDirectory() as repo_dir:
+        cache_dir = Path(cache_dir)
+        repo = set_up_repo(repo_dir)
+        commit_to_repo(repo, "file1_uri.txt", "watcloud://v1/sha256:1", branch="branch1")
+
+        assert get_raw_watcloud_uris(repo_dir, cache_dir) == {"watcloud://v1/sha256:1"}
+        assert len(list(cache_dir.iterdir())) == 1
+
+        # Unchanged refs are served from the cache
+        assert get_raw_watcloud_uris(repo_dir, cache_dir) == {"watcloud://v1/sha256:1"}
+
+        commit_to_repo(repo, "file2_uri.txt", "watcloud://v1/sha256:2", branch="branch2")
+        assert get_raw_watcloud_uris(repo_dir, cache_dir) == {
+            "watcloud://v1/sha256:1",
+            "watcloud://v1/sha256:2",
+        }
+
+        commit_to_repo(repo, "file1_uri.txt", "watcloud://v1/sha256:3", branch="branch1")
+        assert get_raw_watcloud_uris(repo_dir, cache_dir) == {
+            "watcloud://v1/sha256:2",
+            "watcloud://v1/sha256:3",
+        }
+
+        repo.git.checkout("main")
+        repo.delete_head("branch2", force=True)
+        assert get_raw_watcloud_uris(repo_dir, cache_dir) == {"watcloud://v1/sha256:3"}
+
+        # Scanning without a cache gives the same result
+        assert get_raw_watcloud_uris(repo_dir) == {"watcloud://v1/sha256:3"}
+
+
+def test_binary_blobs_are_skipped():
+    """
+    This test commits a binary file that happens to contain a WATcloud URI.
+
+    Like `git grep`, the scan should only report URIs found in text files.
+    """
+    with TemporaryDirectory() as repo_dir:
+        repo = set_up_repo(repo_dir)
+        commit_to_repo(repo, "file_uri.txt", "watcloud://v1/sha256:1\r\n")
+        (Path(repo_dir) / "image.bin").write_bytes(b"\0watcloud://v1/sha256:2")
+        repo.index.add(["image.bin"])
+        repo.index.commit("commit image.bin")
+
+        assert get_raw_watcloud_uris(repo_dir) == {"watcloud://v1/sha256:1"}
+
+
+def test_sharded_scan(monkeypatch):
+    """
+    This test scans a repo with many files, split into shards of one blob each.
+
+    The sharded scan should find the same URIs as a scan in a single process.
+    """
+    with TemporaryDirectory() as repo_dir:
+        repo = set_up_repo(repo_dir)
+        for i in range(4):
+            commit_to_repo(repo, f"file{i}_uri.txt", f"watcloud://v1/sha256:{i}", branch=f"branch{i}")
+        expected = {f"watcloud://v1/sha256:{i}" for i in range(4)}
+
+        assert get_raw_watcloud_uris(repo_dir) == expected
+
+        monkeypatch.setattr("src.utils.SCAN_SHARD_SIZE", 1)
+        monkeypatch.setattr("src.utils.SCAN_PROCESSES", 2)
+        assert get_raw_watcloud_uris(repo_dir) == expected
+
+
+def test_missing_blob_fails_scan():
+    """
+    This test reads a blob that exists alongside one that is missing from the repo.
+
+    Reading should fail rather than skip the missing blob, since a skipped blob would never be scanned again.
+    """
+    with TemporaryDirectory() as repo_dir:
+        repo = set_up_repo(repo_dir)
+        commit_to_repo(repo, "file_uri.txt", "watcloud://v1/sha256:1")
+        present = repo.git.rev_parse("HEAD:file_uri.txt")
+
+        assert list(iter_blob_contents(repo, [present])) == [(present, b"watcloud://v1/sha256:1")]
+        with pytest.raises(ValueError, match="missing"):
+            list(iter_blob_contents(repo, [present, "0" * 40]))
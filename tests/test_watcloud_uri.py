@@ -0,0 +1,86 @@
+from types import SimpleNamespace
+
+import requests
+
+from src.watcloud_uri import Resolver, WATcloudURI, parse_many
+
+PREFIXES = ["https://example.com/asset-perm", "https://example.com/asset-temp", "https://example.com/asset-off-perm"]
+
+
+class FakeSession:
+    def __init__(self, existing_urls):
+        self.existing_urls = existing_urls
+        self.requested_urls = []
+        self.failing_urls = set()
+
+    def head(self, url, timeout=None):
+        self.requested_urls.append(url)
+        if url in self.failing_urls:
+            raise requests.Timeout(f"Timed out requesting {url}")
+        return SimpleNamespace(ok=url in self.existing_urls)
+
+
+def test_resolve_many():
+    """
+    This test resolves URIs of assets in different buckets, then resolves them again.
+
+    Each asset should resolve to the first prefix it is found under, and the second time around,
+    found assets and known misses should be served from the cache without any requests.
+    """
+    in_perm = WATcloudURI(f"watcloud://v1/sha256:{'1' * 64}?name=perm.txt")
+    in_off_perm = WATcloudURI(f"watcloud://v1/sha256:{'2' * 64}?name=off-perm.txt")
+    missing = WATcloudURI(f"watcloud://v1/sha256:{'3' * 64}?name=missing.txt")
+    session = FakeSession({f"{PREFIXES[0]}/{in_perm.sha256}", f"{PREFIXES[2]}/{in_off_perm.sha256}"})
+    resolver = Resolver(PREFIXES, session=session)
+
+    expected = [f"{PREFIXES[0]}/{in_perm.sha256}", f"{PREFIXES[2]}/{in_off_perm.sha256}", None]
+    assert resolver.resolve_many([in_perm, in_off_perm, missing]) == expected
+    assert len(session.requested_urls) == 1 + 3 + 3
+
+    assert resolver.resolve_many([in_perm, in_off_perm, missing]) == expected
+    assert len(session.requested_urls) == 1 + 3 + 3
+
+
+def test_resolve_many_with_failed_requests():
+    """
+    This test resolves a batch of URIs where the request for one of them times out, then resolves them again once it succeeds.
+
+    The failed URI should resolve to None without failing the rest of the batch, and should not be remembered as a miss.
+    """
+    in_perm = WATcloudURI(f"watcloud://v1/sha256:{'1' * 64}?name=perm.txt")
+    flaky = WATcloudURI(f"watcloud://v1/sha256:{'2' * 64}?name=flaky.txt")
+    session = FakeSession({f"{PREFIXES[0]}/{in_perm.sha256}", f"{PREFIXES[0]}/{flaky.sha256}"})
+    session.failing_urls.add(f"{PREFIXES[0]}/{flaky.sha256}")
+    resolver = Resolver(PREFIXES, session=session)
+
+    assert resolver.resolve_many([in_perm, flaky]) == [f"{PREFIXES[0]}/{in_perm.sha256}", None]
+
+    session.failing_urls.clear()
+    expected = [f"{PREFIXES[0]}/{in_perm.sha256}", f"{PREFIXES[0]}/{flaky.sha256}"]
+    assert resolver.resolve_many([in_perm, flaky]) == expected
+
+
+def test_parse_many():
+    """
+    This test parses canonical URIs, URIs that need the general parser, and invalid URIs.
+
+    Valid URIs should parse the same way whichever path they take, and invalid URIs should be reported and skipped.
+    """
+    invalid = []
+    uris = parse_many(
+        [
+            f"watcloud://v1/sha256:{'1' * 64}?name=cloud-light.avif",
+            f"watcloud://v1/sha256:{'2' * 64}",
+            f"watcloud://v1/sha256:{'3' * 64}?name=cloud%20light.avif",
+            f"watcloud://v2/sha256:{'4' * 64}",
+            "watcloud://v1/sha256:5",
+        ],
+        lambda uri, e: invalid.append(uri),
+    )
+
+    assert [(uri.sha256, uri.name) for uri in uris] == [
+        ("1" * 64, "cloud-light.avif"),
+        ("2" * 64, None),
+        ("3" * 64, "cloud light.avif"),
+    ]
+    assert invalid == [f"watcloud://v2/sha256:{'4' * 64}", "watcloud://v1/sha256:5"]